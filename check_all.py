@@ -2,23 +2,51 @@ from urllib.request import Request, urlopen
 from urllib.error import HTTPError
 from datetime import datetime, timedelta
 from xml.etree import ElementTree as ET
+import json
 import logging
+import os
+import threading
+import time
 import traceback
 
 LOGFILE_NAME = 'check_all.log'
+CACHEFILE_NAME = 'check_all.cache.json'
 
 # Basic logger configuration
 logging.basicConfig(level=logging.DEBUG, filename=LOGFILE_NAME, format='<%(asctime)s %(levelname)s> %(message)s')
 
 LOGGER = logging.getLogger(__name__)
 TODAY = datetime.now()
-YESTERDAY = datetime.now() - timedelta(1)
-TWODAYS = datetime.now() - timedelta(2)
 ERROR_WORD = '-FAIL-'
 
+# Every check has to be done after CHECK_TIMEOUT seconds (wall clock). All checks run at the same time,
+# so this is also the longest time that a call of this script waits for results.
+CHECK_TIMEOUT = 20
+
+# Freshness checks only load this many bytes from the beginning or the end of a file
+PART_SIZE = 4096
+CHUNK_SIZE = 16384
+
+# Downloaded bytes and deadline of the check running in the current thread
+REQUEST_STATS = threading.local()
+
 LOGGER.info("=====> CHECK START %s <=====", TODAY)
 
 
+def remaining_time() -> float:
+    # Seconds until the deadline of the check in the current thread, raises TimeoutError when it is over.
+    # urlopen's timeout only limits every single socket operation, so the read loops check this after every chunk.
+    # They use read1(), which returns whatever has arrived, so a server that trickles a few bytes cannot block the check.
+
+    deadline = getattr(REQUEST_STATS, 'deadline', None)
+    if deadline is None:
+        return CHECK_TIMEOUT
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Check took longer than {}s".format(CHECK_TIMEOUT))
+    return remaining
+
+
 def read_url(endpoint: str) -> str:
     # Read data from URL
     # and send our user agent string because [insert reason here]
@@ -28,7 +56,16 @@ def read_url(endpoint: str) -> str:
     req.add_header("User-Agent", "MS OpenData Uptimebot v0.9")
     response = ""
     try:
-        response = urlopen(req).read().decode('utf-8')
+        chunks = []
+        with urlopen(req, timeout=remaining_time()) as http_response:
+            while True:
+                chunk = http_response.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                REQUEST_STATS.bytes = getattr(REQUEST_STATS, 'bytes', 0) + len(chunk)
+                remaining_time()
+        response = b"".join(chunks).decode('utf-8')
 
     except HTTPError as exception:
         response = str(exception) + "\n\n\n\n"
@@ -38,32 +75,132 @@ def read_url(endpoint: str) -> str:
     return response
 
 
-def print_result(name, value):
+def read_url_part(endpoint: str, tail: bool = True) -> str:
+    # Read only the last (or first) PART_SIZE bytes of a file with a HTTP range request.
+    # If the server ignores the range header, we stream the file and keep only that part.
+
+    LOGGER.debug("Requesting %s of %s", "tail" if tail else "head", endpoint)
+    req = Request(endpoint)
+    req.add_header("User-Agent", "MS OpenData Uptimebot v0.9")
+    req.add_header("Range", "bytes=-{}".format(PART_SIZE) if tail else "bytes=0-{}".format(PART_SIZE - 1))
+    response = ""
+    try:
+        with urlopen(req, timeout=remaining_time()) as http_response:
+            part = b""
+            received = 0
+            while True:
+                chunk = http_response.read1(CHUNK_SIZE)
+                received += len(chunk)
+                if not chunk:
+                    break
+                remaining_time()
+                if tail:
+                    part = (part + chunk)[-PART_SIZE:]
+                else:
+                    part = (part + chunk)[0:PART_SIZE]
+                    if len(part) == PART_SIZE:
+                        break
+            LOGGER.debug("HTTP %s, received %s bytes", http_response.status, received)
+        REQUEST_STATS.bytes = getattr(REQUEST_STATS, 'bytes', 0) + received
+        # the part may start or end within a multibyte character
+        response = part.decode('utf-8', errors='ignore')
+
+    except HTTPError as exception:
+        response = str(exception) + "\n\n\n\n"
+        print("<p>Error: %s</p>" % str(exception))
+        LOGGER.error(exception)
+
+    return response
+
+
+def is_wellformed_xml(endpoint: str) -> bool:
+    # Stream the file through an incremental XML parser, without building the whole tree
+
+    LOGGER.debug("Requesting %s", endpoint)
+    req = Request(endpoint)
+    req.add_header("User-Agent", "MS OpenData Uptimebot v0.9")
+    parser = ET.XMLPullParser(events=('end',))
+    received = 0
+    try:
+        with urlopen(req, timeout=remaining_time()) as http_response:
+            while True:
+                chunk = http_response.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                remaining_time()
+                parser.feed(chunk)
+                for event, element in parser.read_events():
+                    element.clear()
+        parser.close()
+
+    except HTTPError as exception:
+        print("<p>Error: %s</p>" % str(exception))
+        LOGGER.error(exception)
+        return False
+
+    finally:
+        REQUEST_STATS.bytes = getattr(REQUEST_STATS, 'bytes', 0) + received
+
+    return True
+
+
+def print_result(name, value, details=''):
     # In the monitoring tool, we search for "-FAIL-" on this page,
     # so let's print that out in case of error
 
-    LOGGER.info("Result %s => %s", name, value)
+    LOGGER.info("Result %s => %s %s", name, value, details)
     if value:
-        print("<p>{}: -OK-</p>".format(name))
+        print("<p>{}: -OK- {}</p>".format(name, details))
     else:
-        print("<p>{}: {}</p>".format(name, ERROR_WORD))
+        print("<p>{}: {} {}</p>".format(name, ERROR_WORD, details))
 
 
-def check_radverkehr():
-    # Load current month's data of Zählstelle "100031297 - Promenade"
-    # and check if it has the newest date in last line
+def run_check(check, results):
+    # Run one check in a worker thread, store its result with its duration and downloaded bytes in results
 
-    currentDate = '{0}-{1:02d}'.format(TWODAYS.year, TWODAYS.month)
-    url = 'https://raw.githubusercontent.com/od-ms/radverkehr-zaehlstellen/main/100031297/{}.csv'.format(currentDate)
-    data = read_url(url)
-    lines = data.splitlines()
-    lastLine = lines[-1]
-    checkDate = '{0}-{1:02d}-{2:02d}'.format(TWODAYS.year, TWODAYS.month, TWODAYS.day)
-    LOGGER.debug("Last line: %s", lastLine)
-    return lastLine[0:10] >= checkDate
+    REQUEST_STATS.bytes = 0
+    start = time.monotonic()
+    REQUEST_STATS.deadline = start + CHECK_TIMEOUT
+    try:
+        value = CHECK_TYPES[check['type']](check)
+        error = None
+    except Exception:
+        value = False
+        error = traceback.format_exc()
+    results[check['name']] = (value, time.monotonic() - start, REQUEST_STATS.bytes, error)
+
+
+def check_line_date(check):
+    # Load a CSV file (url with the date of "url_days" days ago) and check
+    # if the date at the start of the given line is the expected date (of "expect_days" days ago) or newer
+
+    url = check['url'].format(date=TODAY - timedelta(check['url_days']))
+    line_nr = check['line']
+    data = read_url_part(url, tail=(line_nr < 0))
+    line = data.splitlines()[line_nr]
+    checkDate = '{:%Y-%m-%d}'.format(TODAY - timedelta(check['expect_days']))
+    LOGGER.debug("%s %s line %s: %s", checkDate, check['compare'], line_nr, line)
+    if check['compare'] == '==':
+        return line[0:10] == checkDate
+    return line[0:10] >= checkDate
+
+
+def check_xml(check):
+    # Check if the url returns valid XML
+
+    response = False
+    try:
+        response = is_wellformed_xml(check['url'])
+    except ET.ParseError as e:
+        response = False
+        e = traceback.format_exc()
+        LOGGER.debug("Error while reading harvesting file: %s", e)
+
+    return response
 
 
-def check_coronazahlen():
+def check_coronazahlen(check):
     # Check if the date in the 2nd line of the file is at least 3 days old
 
     url = 'https://raw.githubusercontent.com/od-ms/resources/master/coronavirus-fallzahlen-regierungsbezirk-muenster.csv'
@@ -77,56 +214,121 @@ def check_coronazahlen():
     return checkDate >= lastDate
 
 
-def check_parkplaetze():
-    # Check if file with the current date exists and has date in it
-
-    currentDate = '{0}-{1:02d}-{2:02d}'.format(YESTERDAY.year, YESTERDAY.month, YESTERDAY.day)
-    url = 'https://raw.githubusercontent.com/codeformuenster/parking-decks-muenster/master/data/{}.csv'.format(currentDate)
-    data = read_url(url)
-    firstLine = data.splitlines()[2]
-    LOGGER.debug("%s vs. First line: %s", currentDate, firstLine)
-    return firstLine[0:10] == currentDate
-
-
-def check_aasee():
-    # Load current month's CSV data and check if it has the newest date in last line
-
-    currentDate = '{0}-{1:02d}'.format(YESTERDAY.year, YESTERDAY.month)
-    url = 'https://raw.githubusercontent.com/od-ms/aasee-monitoring/main/data/{}.csv'.format(currentDate)
-    data = read_url(url)
-    lines = data.splitlines()
-    lastLine = lines[-1]
-    checkDate = '{0}-{1:02d}-{2:02d}'.format(TWODAYS.year, TWODAYS.month, TWODAYS.day)
-    LOGGER.debug("%s < Last line: %s", checkDate, lastLine)
-    return lastLine[0:10] >= checkDate
-
-
-def check_dcat_ap_harvesting():
-    # Check if the harvesting endpoint of our Open Data Portal returns valid XML
-
-    response = False
+CHECK_TYPES = {
+    'line_date': check_line_date,
+    'xml': check_xml,
+    'coronazahlen': check_coronazahlen,
+}
+
+# All monitored datasets. "interval" is the number of seconds that a successful result
+# is reused before the check runs again (failed checks run on every call).
+CHECKS = [
+    # {'name': 'Coronazahlen', 'type': 'coronazahlen', 'interval': 0},
+    {
+        # File with yesterday's date has to exist and has yesterday's date in the 3rd line
+        'name': 'Parkplaetze',
+        'type': 'line_date',
+        'url': 'https://raw.githubusercontent.com/codeformuenster/parking-decks-muenster/master/data/{date:%Y-%m-%d}.csv',
+        'url_days': 1,
+        'line': 2,
+        'compare': '==',
+        'expect_days': 1,
+        'interval': 0,
+    },
+    {
+        # Current month's data of Zählstelle "100031297 - Promenade" has a date of two days ago in its last line
+        'name': 'Radverkehr',
+        'type': 'line_date',
+        'url': 'https://raw.githubusercontent.com/od-ms/radverkehr-zaehlstellen/main/100031297/{date:%Y-%m}.csv',
+        'url_days': 2,
+        'line': -1,
+        'compare': '>=',
+        'expect_days': 2,
+        'interval': 0,
+    },
+    {
+        # Current month's data has a date of two days ago in its last line
+        'name': 'Aasee',
+        'type': 'line_date',
+        'url': 'https://raw.githubusercontent.com/od-ms/aasee-monitoring/main/data/{date:%Y-%m}.csv',
+        'url_days': 1,
+        'line': -1,
+        'compare': '>=',
+        'expect_days': 2,
+        'interval': 0,
+    },
+    {
+        # Harvesting endpoint of our Open Data Portal returns valid XML
+        'name': 'OpenDataHarvesting',
+        'type': 'xml',
+        'url': 'https://opendata.stadt-muenster.de/dcatapde.xml',
+        'interval': 60 * 60 * 6,
+    },
+]
+
+
+def load_cached_results():
+    # Results of the previous calls, by check name
+
+    if not os.path.exists(CACHEFILE_NAME):
+        return {}
     try:
-        url = 'https://opendata.stadt-muenster.de/dcatapde.xml'
-        data = read_url(url)
-        x = ET.fromstring(data)
-        response = True
-    except ET.ParseError as e:
-        response = False
-        e = traceback.format_exc()
-        LOGGER.debug("Error while reading harvesting file: %s", e)
+        with open(CACHEFILE_NAME, 'r') as cachefile:
+            return json.load(cachefile)
+    except ValueError:
+        LOGGER.warning("Ignoring broken cache file %s", CACHEFILE_NAME)
+        return {}
 
-    return response
+
+def save_cached_results(results):
+    with open(CACHEFILE_NAME + '.tmp', 'w') as cachefile:
+        json.dump(results, cachefile, indent=2)
+    os.replace(CACHEFILE_NAME + '.tmp', CACHEFILE_NAME)
 
 
 def main():
-    # Master control program
+    # Master control program: run all due checks in parallel and print all results in the registry's order
 
     try:
-        # print_result('Coronazahlen', check_coronazahlen())
-        print_result('Parkplaetze', check_parkplaetze())
-        print_result('Radverkehr', check_radverkehr())
-        print_result('Aasee', check_aasee())
-        print_result('OpenDataHarvesting', check_dcat_ap_harvesting())
+        cached_results = load_cached_results()
+        now = time.time()
+        start = time.monotonic()
+        deadline = start + CHECK_TIMEOUT
+        # Daemon threads: a check that hangs after its deadline does not keep the script from exiting
+        threads = {}
+        results = {}
+        for check in CHECKS:
+            cached = cached_results.get(check['name'])
+            if not (cached and now - cached['time'] < check['interval']):
+                threads[check['name']] = threading.Thread(target=run_check, args=(check, results), daemon=True)
+                threads[check['name']].start()
+
+        for check in CHECKS:
+            name = check['name']
+            if name not in threads:
+                cached = cached_results[name]
+                print_result(name, cached['value'], "{} (cached {:%H:%M})".format(cached['details'], datetime.fromtimestamp(cached['time'])))
+                continue
+
+            threads[name].join(max(deadline - time.monotonic(), 0))
+            if name not in results:
+                LOGGER.error("Check %s timed out", name)
+                print_result(name, False, "(timeout after {:.1f}s)".format(time.monotonic() - start))
+                cached_results.pop(name, None)
+                continue
+
+            value, duration, size, error = results[name]
+            details = "({:.2f}s, {} bytes)".format(duration, size)
+            print_result(name, value, details)
+            if error:
+                print("<p>Error: %s</p>" % error)
+                LOGGER.error("ERROR in %s: %s", name, error)
+            if value:
+                cached_results[name] = {'time': now, 'value': value, 'details': details}
+            else:
+                cached_results.pop(name, None)
+
+        save_cached_results(cached_results)
     except:
         print(ERROR_WORD)
         e = traceback.format_exc()
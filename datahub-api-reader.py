@@ -1,4 +1,6 @@
+import re
 import json
+import codecs
 from urllib.request import Request, urlopen
 from datetime import datetime, timedelta, timezone
 import logging
@@ -10,6 +12,20 @@ import pytz
 # config
 LOGFILE_NAME = 'datahub-api-reader.log'
 ALWAYS_USE_CACHE_FILE = 0
+CACHE_FILE = 'data/datahub-cache.json'
+CHUNK_SIZE = 8192
+PACKETS_START = re.compile(r'"packets"\s*:\s*\[')
+OUTDIR = '../aasee-monitoring/data/'
+CSV_HEADER = "Datum,Wassertemperatur,pH-Wert,Sauerstoffgehalt\n"
+
+# only packets of the last MAX_DATA_AGE seconds (= that is our cronjob time) are used for the newest row,
+# and all packets within ROW_WINDOW seconds are combined into one data row
+MAX_DATA_AGE = 600
+ROW_WINDOW = 300
+
+# write all rows from the api feed that are newer than the last row in our csv files,
+# e.g. to fill the gap after an outage (instead of writing only the newest row)
+BACKFILL = 0
 
 # Basic logger configuration
 logging.basicConfig(level=logging.DEBUG, format='<%(asctime)s %(levelname)s> %(message)s')
@@ -21,138 +37,199 @@ LOCAL_TIMEZONE = datetime.now(timezone.utc).astimezone().tzinfo
 LOGGER.info("=====> START %s %s <=====", TODAY, LOCAL_TIMEZONE)
 
 
-def read_api_url(endpoint: str) -> list:
-    # Read data from URL
+def open_api_url(endpoint: str):
+    # Open the URL for reading
     # and send our user agent string because [insert reason here]
 
     LOGGER.debug("Requesting %s", endpoint)
     req = Request(endpoint)
     req.add_header("User-Agent", "MS OpenData ETL v0.9")
-    return urlopen(req).read().decode('utf-8')
+    return urlopen(req)
+
+
+def iter_packets(stream, cache_file=None):
+    # Parse the api response chunk by chunk and return its packets one by one,
+    # so we stop reading as soon as the caller has enough packets.
+    # Everything that was read is also written to the cache file.
+
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_packets = False
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if cache_file:
+            cache_file.write(chunk)
+        buffer += utf8_decoder.decode(chunk, final=not chunk)
+
+        if not in_packets:
+            match = PACKETS_START.search(buffer)
+            if not match:
+                if not chunk:
+                    LOGGER.error("No packets in api response")
+                    return
+                continue
+            buffer = buffer[match.end():]
+            in_packets = True
 
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if buffer[pos:pos + 1] == ']':
+                return
+            try:
+                packet, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # packet is not complete yet
+                break
+            yield packet
+        buffer = buffer[pos:]
 
-def get_api_json():
-    # load & cache the api file and return the json
+        if not chunk:
+            LOGGER.warning("Api response ended within the packets list")
+            return
 
-    sitefile = 'data/datahub-cache.json'
 
-    if ALWAYS_USE_CACHE_FILE and os.path.exists(sitefile):
+def get_api_packets():
+    # load & cache the api file and return its packets
+
+    if ALWAYS_USE_CACHE_FILE and os.path.exists(CACHE_FILE):
 
         # load cached site file
-        f = open(sitefile, "r")
-        content = f.read()
+        with open(CACHE_FILE, "rb") as file:
+            yield from iter_packets(file)
 
     else:
 
-        # read api sites and write cache file
-        content = read_api_url(cfg.datahub_api_url)
-        with open(sitefile, 'w') as file:
-            file.write(content)
-
-    return json.loads(content)
+        # read api packets and write cache file
+        with open_api_url(cfg.datahub_api_url) as response, open(CACHE_FILE, 'wb') as file:
+            yield from iter_packets(response, file)
 
 def get_time(timestring):
     return datetime.strptime(timestring, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
 
-def main():
-    try:
-        data_time_now = datetime.now(TZ)
 
-        datahub = get_api_json()
+def get_outfile(local_time):
+    return OUTDIR + "{}-{:02d}.csv".format(local_time.year, local_time.month)
+
+
+def get_last_written_time(data_time_now):
+    # time of the last row in the csv file of this month (or of last month, if this month's file is empty)
+
+    last_month = data_time_now.replace(day=1) - timedelta(days=1)
+    for outfile in [get_outfile(data_time_now), get_outfile(last_month)]:
+        if not os.path.isfile(outfile):
+            continue
+        with open(outfile, 'rb') as csv_file:
+            csv_file.seek(max(os.path.getsize(outfile) - 200, 0))
+            lines = csv_file.read().decode('utf-8', errors='ignore').splitlines()
+        try:
+            return datetime.strptime(lines[-1][0:16], '%Y-%m-%d %H:%M').astimezone()
+        except (IndexError, ValueError):
+            LOGGER.debug("No data row in %s", outfile)
+    return None
+
+
+def iter_rows(packets, min_time):
+    # Combine the packets (newest first) into data rows in one pass:
+    # we collect all data entries within ROW_WINDOW seconds and create one data row from it
+    # (every entry has different values set, so we collect entries until we have all values).
+    # Yields [utc time, temperature, pH, oxygen] for every complete row, until we reach min_time.
+
+    p_ph = None
+    p_oxy = None
+    p_temp = None
+    p_time = None
+    for item in packets:
+        item_time = get_time(item['source_time'])
+        if min_time and item_time < min_time:
+            LOGGER.debug("Reached data older than %s", min_time)
+            return
+
+        parsed = item['parsed']
+        temp = parsed.get('water_temperature')
+        oxy = parsed.get('dissolved_oxygen')
+        ph = parsed.get('pH')
+
+        if not p_time:
+            p_time = item_time
+            LOGGER.debug("Time from API: %s", item['source_time'])
+        else:
+            # if nothing has changed, use the new entry's timestamp
+            if not ((temp and temp != p_temp) or (ph and ph != p_ph) or (oxy and oxy != p_oxy)):
+                p_time = item_time
+                LOGGER.debug("New Time: %s (no data change)", item['source_time'])
+                continue
 
-        p_ph = None
-        p_oxy = None
-        p_temp = None
-        p_date = None
-        for item in datahub['data']['packets']:
+            # data points should be within ROW_WINDOW
+            difference = abs((p_time - item_time).total_seconds())
+            if difference > ROW_WINDOW:
+                LOGGER.debug("Time reset ====> difference: %ss too large", difference)
+                p_time = item_time
+                p_ph = None
+                p_oxy = None
+                p_temp = None
 
-            # check if data entry is older than 10 minutes (= that is our cronjob time)
-            date_time_obj = get_time(item['source_time'])
-            data_age = data_time_now - date_time_obj
-            if data_age.total_seconds() > 600:
-                LOGGER.debug("Data age: %ss", data_age.total_seconds())
-                LOGGER.error("Data older than 15 minutes, skipping")
-                continue
+        # now get the values
+        p_temp = temp or p_temp
+        p_oxy = oxy or p_oxy
+        p_ph = ph or p_ph
+        LOGGER.debug("Got values: temp=%s ph=%s oxy=%s", p_temp, p_ph, p_oxy)
 
-            # assemble a data row:
-            # we collect all data entries within 5 minutes and create one data row from it
-            # (every entry has different values set, so we collect entries until we have all values)
-            if not p_date:
-                p_date = item['source_time']
-                LOGGER.debug("Time from API: %s", p_date)
-            else:
-
-                # calculate the time difference to our last entry
-                date_time_obj1 = datetime.strptime(p_date, '%Y-%m-%dT%H:%M:%S.%fZ')
-                date_time_obj2 = datetime.strptime(item['source_time'], '%Y-%m-%dT%H:%M:%S.%fZ')
-                difference = date_time_obj1 - date_time_obj2
-                # LOGGER.debug("Time difference: %ss", difference.total_seconds())
-
-                # if nothing has changed, use the new entry's timestamp
-                value_has_changed = 0
-                for key, value in item['parsed'].items():
-                    if key == 'water_temperature':
-                        if value and (p_temp != value):
-                            value_has_changed += 1
-                    if key == 'dissolved_oxygen':
-                        if value and (p_oxy != value):
-                            value_has_changed += 1
-                    if key == 'pH':
-                        if value and (p_ph != value):
-                            value_has_changed += 1
-                if not value_has_changed:
-                    p_date = item['source_time']
-                    LOGGER.debug("New Time: %s (no data change)", p_date)
-                    continue
-
-                else:
-                    # data points should be within 5 minutes
-                    if abs(difference.total_seconds()) > 300:
-                        LOGGER.debug("Time reset ====> difference: %ss too large", abs(difference.total_seconds()))
-                        p_date = item['source_time']
-                        p_ph = None
-                        p_oxy = None
-                        p_temp = None
-
-            # now get the values
-            for key, value in item['parsed'].items():
-                if key == 'water_temperature':
-                    p_temp = value
-                if key == 'dissolved_oxygen':
-                    p_oxy = value
-                if key == 'pH':
-                    p_ph = value
-
-                if p_temp or p_ph or p_oxy:
-                    LOGGER.debug("Got values: temp=%s ph=%s oxy=%s", p_temp, p_ph, p_oxy)
-
-                if p_temp and p_ph and p_oxy:
-                    break
-            else:
-                # Continue if the inner loop wasn't broken.
-                continue
-            # Inner loop was broken, break the outer.
-            break
+        if p_temp and p_ph and p_oxy:
+            yield [p_time, p_temp, p_ph, p_oxy]
+            p_time = None
+            p_ph = None
+            p_oxy = None
+            p_temp = None
+
+
+def write_rows(rows):
+    # append the rows (oldest first) to the csv file of their month (and convert data's utc timestamp to our timezone)
+
+    for p_time, p_temp, p_ph, p_oxy in rows:
+        current_timestamp = p_time.astimezone(tz=None)
+        p_date_str = str(current_timestamp)
+        csv_line = "{},{:.2f},{:.2f},{:.2f}\n".format(p_date_str[0:16].replace("T", " "), p_temp, p_ph, p_oxy)
+        print(csv_line)
+
+        # check if file exists
+        outfile = get_outfile(current_timestamp)
+        file_exists = (os.path.exists(outfile) and os.path.isfile(outfile))
 
+        # finally write the data to csv
+        with open(outfile, mode='a') as csv_file:
+            if not file_exists:
+                csv_file.write(CSV_HEADER)
 
-        if p_date:
-            # prepare csv content (and convert data's utc timestamp to our timezone)
-            current_timestamp = get_time(p_date).replace(tzinfo=timezone.utc).astimezone(tz=None)
-            p_date_str = str(current_timestamp)
-            csv_line = "{},{:.2f},{:.2f},{:.2f}\n".format(p_date_str[0:16].replace("T", " "), p_temp, p_ph, p_oxy)
-            print(csv_line)
+            csv_file.write(csv_line)
 
-            # check if file exists
-            outdir = '../aasee-monitoring/data/'
-            outfile = outdir + "{}-{:02d}.csv".format(data_time_now.year,data_time_now.month)
-            file_exists = (os.path.exists(outfile) and os.path.isfile(outfile))
 
-            # finally write the data to csv
-            with open(outfile, mode='a') as csv_file:
-                if not file_exists:
-                    csv_file.write("Datum,Wassertemperatur,pH-Wert,Sauerstoffgehalt\n")
+def main():
+    try:
+        data_time_now = datetime.now(TZ)
+
+        # never write a row twice: start after the minute of the last row we have written
+        min_time = get_last_written_time(data_time_now)
+        if min_time:
+            min_time = min_time + timedelta(minutes=1)
+        if not BACKFILL:
+            max_age_time = data_time_now - timedelta(seconds=MAX_DATA_AGE)
+            min_time = max(min_time, max_age_time) if min_time else max_age_time
+        LOGGER.debug("Using data since %s", min_time)
+
+        packets = get_api_packets()
+        rows = iter_rows(packets, min_time)
+        if BACKFILL:
+            rows = list(rows)
+        else:
+            newest_row = next(rows, None)
+            rows = [newest_row] if newest_row else []
+        packets.close()
 
-                csv_file.write(csv_line)
+        if rows:
+            write_rows(reversed(rows))
         else:
             LOGGER.warning("SKIPPING CSV WRITE, did not get data")
 
@@ -4,7 +4,12 @@ import re
 import csv
 import sys
 import json
-from datetime import datetime
+import time
+import hashlib
+from array import array
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from urllib.error import URLError
 from urllib.request import Request,urlopen
 import config as cfg
@@ -13,16 +18,48 @@ token = cfg.eco_counter_token
 outdir = '../radverkehr-zaehlstellen/'
 sitefile = outdir + 'site.json'
 infofile = outdir + 'SITE_INDEX.md'
+statefile = outdir + 'sync_state.json'
 startYear = 2023 # angepasst auf die neuen Zählstellen, für die alten nehme man "2019"
 
+# the api host is queried with this many parallel requests,
+# and we wait at least request_interval seconds between two requests
+max_parallel_requests = 4
+request_interval = 0.25
+
+# only request the rows of the current month that are not complete in its csv file yet,
+# and append them to the file instead of rewriting the whole month
+incremental_update = 1
+
+# months whose channels don't have data up to the end of the month are fetched again,
+# until the month is that many days over
+retry_incomplete_months_days = 7
 
 api_url = cfg.eco_counter_api_url
 wanted_ids = cfg.eco_counter_ids
 
 content = ""
 
+# marks a value that a channel did not deliver in the columnar month data
+MISSING = -2**63
+
+request_lock = threading.Lock()
+next_request_time = 0
+
+
+def wait_for_request_slot():
+    """ rate limit: block until the next request to the api host is allowed """
+    global next_request_time
+    with request_lock:
+        now = time.monotonic()
+        wait = next_request_time - now
+        next_request_time = max(now, next_request_time) + request_interval
+    if wait > 0:
+        time.sleep(wait)
+
+
 def read_api_url(endpoint):
     """ read site data from eco counter api """
+    wait_for_request_slot()
     req = Request(api_url + endpoint)
     req.add_header("Authorization", "Bearer {}".format(token))
     req.add_header("Accept", "application/json")
@@ -33,7 +70,7 @@ def read_api_url(endpoint):
         print(e.code)
         print(e.read())
         print(e)
-        exit()
+        raise
     return response
 
 
@@ -112,7 +149,165 @@ with open(infofile, 'w') as ifile:
 with open(outdir + 'site_min.json', 'w') as file:
     file.write(json.dumps(sites, indent=4))
 
+
+def read_channel_data(channel_url):
+    """ fetch one channel of one month, runs in the worker threads """
+    return json.loads(read_api_url(channel_url))
+
+
+def load_sync_state():
+    """ the sync state remembers for every site, month and channel what we have fetched """
+    if not os.path.exists(statefile):
+        return {}
+    with open(statefile, 'r') as file:
+        return json.load(file)
+
+
+def save_sync_state(state):
+    """ write the state file atomically, so an interrupted run can resume from it """
+    with open(statefile + '.tmp', 'w') as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+    os.replace(statefile + '.tmp', statefile)
+
+
+def get_month_state(site_channels, enddate, file_summary):
+    """ state of a fetched month; it is complete when all channels have data up to the end of the month """
+    fetch_time = datetime.now()
+    last_slot = (datetime.fromisoformat(enddate) - timedelta(minutes=15)).strftime('%Y-%m-%dT%H:%M')
+    month_state = {"complete": True, "channels": {}}
+    for chan, (rows, last_timestamp, content_hash) in zip(site_channels, file_summary):
+        month_state['channels'][str(chan['id'])] = {
+            "fetched": fetch_time.isoformat(timespec='seconds'),
+            "rows": rows,
+            "last": last_timestamp,
+            "hash": content_hash
+        }
+        if not last_timestamp or last_timestamp[0:16] < last_slot:
+            month_state['complete'] = False
+
+    if fetch_time > datetime.fromisoformat(enddate) + timedelta(days=retry_incomplete_months_days):
+        month_state['complete'] = True
+    return month_state
+
+
+def get_channel_titles(site_channels):
+    """ Headline row: Time, channel-ids, and channel-ids + "-status" """
+    channel_titles = ['Datetime']
+    for chan in site_channels:
+        channel_titles.append("{} ({})".format(chan['id'], chan['name']))
+    for chan in site_channels:
+        channel_titles.append("{}-status".format(chan['id']))
+    return channel_titles
+
+
+def find_resume_point(datafile, site_channels):
+    """ return [file offset, timestamp] of the last row of an existing monthly file
+        that has counts for all channels, or None if the file has to be written from scratch """
+    with open(datafile, 'rb') as file:
+        lines = file.readlines()
+    if len(lines) < 2:
+        return None
+
+    # the channels of the site have changed, so we cannot just append to the file
+    headline = next(csv.reader([lines[0].decode('utf-8')]))
+    if headline != get_channel_titles(site_channels):
+        print(" => Channels changed, rewriting: {}".format(datafile))
+        return None
+
+    offset = sum(len(line) for line in lines)
+    for line in reversed(lines[1:]):
+        offset -= len(line)
+        row = next(csv.reader([line.decode('utf-8')]))
+        if len(row) == 1 + 2 * len(site_channels) and all(row[1:1 + len(site_channels)]):
+            return [offset, row[0].replace(' ', 'T') + ':00']
+    return None
+
+
+def summarize_month_file(datafile, site_channels):
+    """ [rows, last timestamp, content hash] of every channel in the monthly file,
+        the hash covers the channel's timestamps, counts and status """
+    summary = [[0, None, hashlib.sha1()] for chan in site_channels]
+    if os.path.exists(datafile):
+        with open(datafile, 'r', newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                for nr, channel_summary in enumerate(summary):
+                    count, status = row[1 + nr], row[1 + len(site_channels) + nr]
+                    if count or status:
+                        channel_summary[0] += 1
+                        channel_summary[1] = row[0].replace(' ', 'T')
+                        channel_summary[2].update('{},{},{}\n'.format(row[0], count, status).encode('utf-8'))
+    return [[rows, last_timestamp, content_hash.hexdigest()] for rows, last_timestamp, content_hash in summary]
+
+
+def new_column(length, values):
+    """ column of length rows with the given (row, value) pairs and MISSING in all other rows:
+        an int64 array, or a plain list if the API returns values that are no integers (e.g. float counts) """
+    values = [(row, value) for row, value in values if value is not None]
+    if all(type(value) is int and MISSING < value < 2**63 for row, value in values):
+        column = array('q', [MISSING]) * length
+    else:
+        column = [MISSING] * length
+    for row, value in values:
+        column[row] = value
+    return column
+
+
+def build_month_columns(channel_results):
+    """ columnar month data: the timestamps of all channels (in the order they appear)
+        and one counts and one status column per channel, MISSING where a channel has no value """
+    row_index = {}
+    for channel_data in channel_results:
+        for entry in channel_data:
+            row_index.setdefault(entry['date'], len(row_index))
+
+    count_columns = []
+    status_columns = []
+    for channel_data in channel_results:
+        rows = [row_index[entry['date']] for entry in channel_data]
+        count_columns.append(new_column(len(row_index), zip(rows, (entry['counts'] for entry in channel_data))))
+        status_columns.append(new_column(len(row_index), zip(rows, (entry['status'] for entry in channel_data))))
+
+    return list(row_index), count_columns, status_columns
+
+
+def write_month_file(datafile, site_channels, channel_results, append_at=None):
+    """ combine the data of all channels of one month and write the csv file,
+        or replace the file's rows from byte offset append_at on with the new rows.
+        Returns the summary of the whole file (see summarize_month_file) """
+    for chan, channel_data in zip(site_channels, channel_results):
+        if not channel_data:
+            print(" => Empty response {} ({})".format(chan['id'], datafile))
+
+    timestamps, count_columns, status_columns = build_month_columns(channel_results)
+    if not timestamps:
+        print(" =>> Empty Site! Skipping file {}.".format(datafile))
+        return summarize_month_file(datafile, site_channels)
+
+    if append_at is not None:
+        print(" ==> Appending {} rows: {}".format(len(timestamps), datafile))
+        os.truncate(datafile, append_at)
+    else:
+        print(" ==> Writing: {}".format(datafile))
+    with open(datafile, 'w' if append_at is None else 'a') as csvfile:
+        csvfile = csv.writer(csvfile)
+
+        if append_at is None:
+            csvfile.writerow(get_channel_titles(site_channels))
+
+        # Now write all channels into one csv file, the rows are streamed from the columns
+        columns = [(ctime[0:16].replace('T',' ') for ctime in timestamps)]
+        for column in [*count_columns, *status_columns]:
+            columns.append(('' if value == MISSING else value for value in column))
+        csvfile.writerows(zip(*columns))
+
+    return summarize_month_file(datafile, site_channels)
+
+
 # write all data files for all sites and channels into site subdirectories and create dirs if missing
+sync_state = load_sync_state()
+executor = ThreadPoolExecutor(max_workers=max_parallel_requests)
 for site in sites:
     currentDate = '{0}-{1:02d}'.format(datetime.now().year,datetime.now().month)
     sitedir = outdir + site['directory']
@@ -130,6 +325,13 @@ for site in sites:
             print(f"   <***> SKIPPING site {site['name']}")
             continue
 
+    site_channels = []
+    for channel in site['channels']:
+        site_channels.append({"id": channel[0], "name": channel[1]})
+    site_state = sync_state.setdefault(site['directory'], {})
+
+    # queue the requests of all months and channels of this site ...
+    pending_months = []
     while processingMonth < currentDate:
 
         processingMonth = '{0}-{1:02d}'.format(year,month)
@@ -142,56 +344,39 @@ for site in sites:
             year+=1
         enddate = '{0}-{1:02d}-01T00:00:00'.format(year,month)
 
-        if (processingMonth == currentDate) or (not os.path.exists(datafile)):
+        # skip the months that are complete, and (for sites without sync state yet) months that have a file
+        month_state = site_state.get(processingMonth)
+        if month_state:
+            fetch_month = (processingMonth == currentDate) or (not month_state['complete'])
+        else:
+            fetch_month = (processingMonth == currentDate) or (not os.path.exists(datafile))
+
+        if fetch_month:
             print("======== Reading {} // {} ========".format(processingMonth, site['name']))
-            site_data = {}
-            site_channels = []
-
-            for channel in site['channels']:
-                channel_id = channel[0]
-                channel_name = channel[1]
-                print(" > Channel {} {}".format(channel_id, channel_name))
-                site_channels.append({"id": channel_id, "name": channel_name})
-                channel_url = '/data/site/{}?begin={}&end={}&step=15m&complete=false'.format(channel_id, startdate, enddate)
+            append_at = None
+            if incremental_update and os.path.exists(datafile):
+                resume_point = find_resume_point(datafile, site_channels)
+                if resume_point:
+                    append_at, startdate = resume_point
+                    print(" > Incremental update from {}".format(startdate))
+            channel_futures = []
+            for chan in site_channels:
+                print(" > Channel {} {}".format(chan['id'], chan['name']))
+                channel_url = '/data/site/{}?begin={}&end={}&step=15m&complete=false'.format(chan['id'], startdate, enddate)
                 print(" > Url: {}".format(channel_url))
-                channel_json = read_api_url(channel_url)
-                channel_data = json.loads(channel_json)
-                if not channel_data:
-                    print(" => Empty response")
-                #else:
-                #    time.sleep(1)
-
-                for entry in channel_data:
-                    date = entry['date']
-                    if not date in site_data:
-                        site_data[date] = {}
-                    site_data[date][channel_id] = [entry['counts'], entry['status']]
-
-            if not site_data:
-                print(" =>> Empty Site! Skipping file.")
-            else:
-                print(" ==> Writing: {}".format(datafile))
-                with open(datafile, 'w') as csvfile:
-                    csvfile = csv.writer(csvfile)
-
-                    # Headline row: Time, channel-ids, and channel-ids + "-status"
-                    channel_titles = ['Datetime']
-                    for chan in site_channels:
-                        channel_titles.append("{} ({})".format(chan['id'], chan['name']))
-                    for chan in site_channels:
-                        channel_titles.append("{}-status".format(chan['id']))
-                    csvfile.writerow(channel_titles)
-
-                    # Now write all channels into one csv file
-                    for ctime, cdata in site_data.items():
-                        row_data = [ctime[0:16].replace('T',' ')]
-                        row_status = []
-                        for chan in site_channels:
-                            row_channel_id = chan['id']
-                            if row_channel_id in cdata:
-                                row_data.append(cdata[row_channel_id][0])
-                                row_status.append(cdata[row_channel_id][1])
-                            else:
-                                row_data.append('')
-                                row_status.append('')
-                        csvfile.writerow([*row_data,*row_status])
+                channel_futures.append(executor.submit(read_channel_data, channel_url))
+            pending_months.append([processingMonth, datafile, enddate, channel_futures, append_at])
+
+    # ... and write each month's file as soon as all of its channels have arrived
+    try:
+        for processingMonth, datafile, enddate, channel_futures, append_at in pending_months:
+            channel_results = [future.result() for future in channel_futures]
+            file_summary = write_month_file(datafile, site_channels, channel_results, append_at)
+            site_state[processingMonth] = get_month_state(site_channels, enddate, file_summary)
+            save_sync_state(sync_state)
+    except Exception:
+        # a failed request (e.g. 401 or 5xx) stops the script, without sending the queued requests to the api
+        executor.shutdown(cancel_futures=True)
+        raise
+
+executor.shutdown()
@@ -12,7 +12,7 @@ MASTR1 = "ABR979186451947" # Amt für Immobilienmanagement
 MASTR2 = "ABR990157438859" # Amt für Mobilität und Tiefbau
 
 # CSV-Datei laden
-df = pd.read_csv('../../solar-und-windkraft-muenster/alle-anlagen-muenster.csv')
+df = pd.read_csv('../../solar-und-windkraft-muenster/anlagen-stadtverwaltung-muenster.csv')
 
 # Zeilen filtern, z.B. nur Zeilen mit Wert 'foo' in der ersten Spalte
 gefiltert = df[(df['AnlagenbetreiberMaStRNummer'] == MASTR1) | (df['AnlagenbetreiberMaStRNummer'] == MASTR2)]
@@ -5,17 +5,20 @@
 
 import os
 import os.path
-import time
+import sys
 import csv
 import re
 import json
 import random
 import logging
+from contextlib import ExitStack
 from datetime import datetime
-import requests
 from pyfiglet import Figlet
 from io import StringIO
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import url_cache  # pylint: disable=wrong-import-position
+
 
 
 # Basic logger configuration
@@ -36,40 +39,26 @@ logging.debug("(headline font = '%s')", HEADLINE_FONT)
 # Use cosmic font, it rocks
 # HEADLINE_FONT = "cosmic"
 
+CACHE_MAX_AGE = 60 * 60 * 24 * 30 # days
+
 SOURCE_URL = 'https://data.bundesnetzagentur.de/Bundesnetzagentur/SharedDocs/Downloads/DE/Sachgebiete/Energie/Unternehmen_Institutionen/E_Mobilitaet/Ladesaeulenregister.csv'
 
+# Regional exports, all of them are written in one pass over the register: ladesaeulen-{name}.csv and .json
+# The rows of a region are selected by "kreis" (column "Kreis/kreisfreie Stadt"), "ort" (column "Ort")
+# or "polygon" ([Längengrad, Breitengrad] points). Rows with coordinates below "min_coordinates" are skipped in the GeoJSON.
+REGIONS = [
+    {"name": "muenster", "kreis": ["Kreisfreie Stadt Münster"], "min_coordinates": [7, 51]},
+    # {"name": "steinfurt", "kreis": ["Kreis Steinfurt"]},
+    # {"name": "greven", "ort": ["Greven"]},
+    # {"name": "muenster-innenstadt", "polygon": [[7.60, 51.95], [7.65, 51.95], [7.65, 51.97], [7.60, 51.97]]},
+]
 
-def read_url_with_cache(url):
-    """ Read URLs only once, and cache them to files """
-    filename = f'cache/{format(re.sub("[^0-9a-zA-Z]+", "_", os.path.basename(url)))[0:250]}'
 
-    current_ts = time.time()
-    cache_max_age = 60 * 60 * 24 * 30 # days
-    generate_cache_file = True
-    filecontent = ""
-    if os.path.isfile(filename):
-        file_mod_time = os.path.getmtime(filename)
-        time_diff = current_ts - file_mod_time
-        if time_diff > cache_max_age:
-            logging.debug("# CACHE file age %s too old: %s", time_diff, filename)
-        else:
-            generate_cache_file = False
-            logging.debug("(using cached file instead of url get)")
-            with open(filename, encoding='utf-8') as myfile:
-                filecontent = "".join(line for line in myfile)
-
-    if generate_cache_file:
-        logging.debug("# URL HTTP GET %s ", filename)
-        req = requests.get(url, timeout=10)
-        if req.status_code > 399:
-            logging.warning('  - Request result: HTTP %s - %s', req.status_code, url)
-
-        open(filename, 'wb').write(req.content)
-        filecontent = req.text
-        # lets wat a bit, dont kill a public server
-        time.sleep(1)
-
-    return filecontent
+def download_url_with_cache(url):
+    """ Download URLs only once, and cache them to files. Returns the name of the cache file """
+    filename = f'cache/{format(re.sub("[^0-9a-zA-Z]+", "_", os.path.basename(url)))[0:250]}'
+    url_cache.download_with_cache(url, filename, CACHE_MAX_AGE, timeout=10)
+    return filename
 
 #               0           1       2               3           4               5   6           7                           8                   9               10                        11                            12
 FIRST_ROW = '"Betreiber";"Straße";"Hausnummer";"Adresszusatz";"Postleitzahl";"Ort";"Bundesland";"Kreis/kreisfreie Stadt";"Breitengrad";"Längengrad";"Inbetriebnahmedatum";"Nennleistung Ladeeinrichtung [kW]";"Art der Ladeeinrichung";"Anzahl Ladepunkte";"Steckertypen1";"P1 [kW]";"Public Key1";"Steckertypen2";"P2 [kW]";"Public Key2";"Steckertypen3";"P3 [kW]";"Public Key3";"Steckertypen4";"P4 [kW]";"Public Key4"'
@@ -84,58 +73,96 @@ def compare_first_row(row):
         raise ValueError("Unexpected header row in CSV")
 
 
-def wget_stationen(source_url):
-    """ Stationen auslesen """
-    filecontent = read_url_with_cache(source_url)
-    f = StringIO(filecontent)
-    csvreader = csv.reader(f, delimiter=';')
+def parse_point(row):
+    """ [Längengrad, Breitengrad] of a row, None if the row has no valid coordinates """
+    try:
+        return [float(row[9].replace(',', '.')), float(row[8].replace(',', '.'))]
+    except (ValueError, IndexError):
+        return None
+
+
+def point_in_polygon(point, polygon):
+    """ Ray casting: a point is inside if a ray from it to the east crosses the polygon edges an odd number of times """
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def region_contains(region, row, point):
+    if row[7] in region.get("kreis", ()) or row[5] in region.get("ort", ()):
+        return True
+    if "polygon" in region and point:
+        return point_in_polygon(point, region["polygon"])
+    return False
+
+
+def station_properties(row):
+    return {
+        'Typ': row[10],
+        'Betreiber': row[0],
+        'Inbetriebnahme': row[10],
+        'Nennleistung[kW]': row[11],
+        'Ladeeinrichung': row[12],
+        'Anzahl Ladepunkte': row[13],
+        'Steckertypen': row[14],
+        'Ladeleistung[kW]': row[15]
+    }
 
-    # first 10 rows are file description text
-    for count in range ( 0, 10 ):
-        logging.debug("%s", next(csvreader, None))
 
-    # check if file format is still the same
-    firstrow = next(csvreader, None)
-    compare_first_row(firstrow)
+def wget_stationen(source_url, regions):
+    """ Stationen auslesen, returns the GeoJSON entries of every region """
+    cachefile = download_url_with_cache(source_url)
+    needs_point = any("polygon" in region for region in regions)
+    stationen_geojson_lists = {region["name"]: [] for region in regions}
 
+    # The national register is read row by row from the cache file, every row is routed to the regions it belongs to
+    with ExitStack() as stack:
+        infile = stack.enter_context(open(cachefile, newline='', encoding='utf-8'))
+        csvreader = csv.reader(infile, delimiter=';')
 
-    big_debug_text("Start reading CSV...")
+        # first 10 rows are file description text
+        for count in range ( 0, 10 ):
+            logging.debug("%s", next(csvreader, None))
 
-    stationen_geojson_list = []
+        # check if file format is still the same
+        firstrow = next(csvreader, None)
+        compare_first_row(firstrow)
 
-    with open("ladesaeulen-muenster.csv", 'w', newline='', encoding='utf-8') as outfile:
-        outwriter = csv.writer(outfile, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-        outwriter.writerow(list(firstrow))
+        big_debug_text("Start reading CSV...")
+
+        outwriters = {}
+        for region in regions:
+            outfile = stack.enter_context(open(f"ladesaeulen-{region['name']}.csv", 'w', newline='', encoding='utf-8'))
+            outwriters[region["name"]] = csv.writer(outfile, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            outwriters[region["name"]].writerow(list(firstrow))
 
 
         for row in csvreader:
-            if row[7] != 'Kreisfreie Stadt Münster':
-                continue
-
-            logging.debug("Found a row %s", row[0:9])
-            outwriter.writerow(row)
-            lat = float(row[9].replace(',','.'))
-            lon = float(row[8].replace(',','.'))
-            if (lat < 7) or (lon < 51):
-                logging.warning("SKIP out of range lat %s, lon %s: %s", lat, lon, row)
-                continue
-
-            stationen_geojson_list.append([
-                [lat, lon],
-                {
-                    'Typ': row[10],
-                    'Betreiber': row[0],
-                    'Inbetriebnahme': row[10],
-                    'Nennleistung[kW]': row[11],
-                    'Ladeeinrichung': row[12],
-                    'Anzahl Ladepunkte': row[13],
-                    'Steckertypen': row[14],
-                    'Ladeleistung[kW]': row[15]
-                }
-            ])
-
-    return stationen_geojson_list
+            point = parse_point(row) if needs_point else None
+
+            for region in regions:
+                if not region_contains(region, row, point):
+                    continue
+
+                logging.debug("Found a row for %s: %s", region["name"], row[0:9])
+                outwriters[region["name"]].writerow(row)
+
+                station_point = point or parse_point(row)
+                if not station_point:
+                    logging.warning("SKIP invalid coordinates: %s", row)
+                    continue
+                min_coordinates = region.get("min_coordinates")
+                if min_coordinates and (station_point[0] < min_coordinates[0] or station_point[1] < min_coordinates[1]):
+                    logging.warning("SKIP out of range lat %s, lon %s: %s", station_point[0], station_point[1], row)
+                    continue
+
+                stationen_geojson_lists[region["name"]].append([station_point, station_properties(row)])
+
+    return stationen_geojson_lists
 
 
 
@@ -179,9 +206,10 @@ def main_process(source_url):
     """ ▂▃▅▇█▓▒░۩۞۩ MAIN ۩۞۩░▒▓█▇▅▃▂ """
 
     big_debug_text("Reading Stationen Data")
-    stationen_data = wget_stationen(source_url)
+    stationen_data = wget_stationen(source_url, REGIONS)
 
-    write_json_file(stationen_data, "ladesaeulen-muenster.json")
+    for region_name, stationen in stationen_data.items():
+        write_json_file(stationen, f"ladesaeulen-{region_name}.json")
 
 
 
@@ -1,10 +1,15 @@
 #!/bin/bash
 
+# load_data_from_mstr.py writes alle-anlagen-muenster.csv and anlagen-stadtverwaltung-muenster.csv (used by the klimadashboard),
+# load_detailed_data_from_mstr.py runs last, so the anlagen_*.json files contain the detailed values
+python3 load_data_from_mstr.py
 python3 load_detailed_data_from_mstr.py
 
-cat alle-anlagen-muenster-details.csv | grep -P "AnlagenbetreiberId|,Speicher," >stromspeicher-muenster.csv
-
-cp *.csv ../../solar-und-windkraft-muenster/
+# Published files: the complete lists, and the exports of the local stores (see CSV_EXPORTS in the loaders)
+cp alle-anlagen-muenster.csv alle-anlagen-muenster-details.csv \
+   stromspeicher-muenster.csv windanlagen-muenster.csv solaranlagen-muenster.csv \
+   anlagen-stadtverwaltung-muenster.csv \
+   ../../solar-und-windkraft-muenster/
 
 echo .
 echo "now check and commit all files in ../../solar-und-windkraft-muenster/"
@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+""" Count and sum up the values of MaStR Anlagen for several Energieträger in one pass """
+
+import re
+import logging
+from collections import Counter
+
+
+def aggregate(pages, spec):
+    """
+    Aggregate the Anlagen of all pages, grouped by spec['group_by'] (only the values in spec['groups']).
+    For every group, count the values of the fields in spec['counts'] ("Werte") and add up
+    the fields in spec['sums'] ("Summen"), and also the Anlagen of the Stadtverwaltung.
+
+    spec keys: group_by, groups, counts, sums, skip_status (list of BetriebsStatusName), ort,
+    city_operator (regex for AnlagenbetreiberName of the Stadtverwaltung)
+    """
+    is_city_operator = re.compile(spec['city_operator']).match
+    skip_status = set(spec['skip_status'])
+    group_by = spec['group_by']
+    ort = spec['ort']
+    count_fields = spec['counts']
+    sum_fields = spec['sums']
+
+    counters = {group: {field: Counter() for field in count_fields} for group in spec['groups']}
+    sums = {group: dict.fromkeys(sum_fields, 0) for group in spec['groups']}
+    city_sums = {group: [0, 0, 0] for group in spec['groups']}
+    anlagen_count = dict.fromkeys(spec['groups'], 0)
+    seen_ids = {group: set() for group in spec['groups']}
+    doppelt_count = 0
+
+    for anlagen in pages:
+        for anlage in anlagen:
+            group = anlage[group_by]
+            if group not in counters:
+                continue
+            if anlage["BetriebsStatusName"] in skip_status:
+                continue
+            if anlage["Ort"] != ort:
+                continue
+
+            # Skip anlagen that we already have
+            anlagen_id = anlage['MaStRNummer']
+            if anlagen_id in seen_ids[group]:
+                doppelt_count = doppelt_count + 1
+                continue
+            seen_ids[group].add(anlagen_id)
+
+            # Count Stadt Münster Anlagen
+            operator = anlage["AnlagenbetreiberName"]
+            if isinstance(operator, str) and is_city_operator(operator):
+                city = city_sums[group]
+                city[0] += 1
+                city[1] += anlage["Bruttoleistung"]
+                city[2] += anlage["Nettonennleistung"]
+
+            anlagen_count[group] += 1
+            group_counters = counters[group]
+            for field in count_fields:
+                if field in anlage:
+                    group_counters[field][anlage[field]] += 1
+            group_sums = sums[group]
+            for field in sum_fields:
+                value = anlage.get(field)
+                if value:
+                    group_sums[field] += int(value)
+
+    logging.debug("Doppelte: %s", doppelt_count)
+
+    results = {}
+    for group in spec['groups']:
+        # the json files have the values as strings, e.g. "True" or "None"
+        wanted_collections = {}
+        for field, counter in counters[group].items():
+            values = {}
+            for value, count in counter.items():
+                values[str(value)] = values.get(str(value), 0) + count
+            wanted_collections[field] = values
+
+        wanted_sums = sums[group]
+        wanted_sums["StadtverwaltungAnlagen"] = city_sums[group][0]
+        wanted_sums["StadtverwaltungBruttoleistung"] = round(city_sums[group][1])
+        wanted_sums["StadtverwaltungNettonennleistung"] = round(city_sums[group][2])
+        if anlagen_count[group]:
+            wanted_sums["AnzahlAnlagen"] = anlagen_count[group]
+
+        results[group] = {"Summen": wanted_sums, "Werte": wanted_collections}
+    return results
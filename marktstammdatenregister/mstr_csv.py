@@ -0,0 +1,105 @@
+# -*- coding: UTF-8 -*-
+""" Write MaStR Anlagen page by page into one CSV file, with anonymised operators and readable dates """
+
+import re
+import csv
+import logging
+from datetime import datetime
+from functools import lru_cache
+
+# Some columns contain the weird string "/Date(...)/"
+DATE_PREFIX = "/Date("
+DATE_VALUE = re.compile(r"/Date\((\d+)\)/")
+
+# Operators whose names are not anonymised: Stadt Münster and its Ämter, Stadtbau and AWM
+PUBLIC_OPERATOR = re.compile(r"^Stadt.*Münster|Amt|Stadtbau|AWM")
+
+
+@lru_cache(maxsize=None)
+def convert_date(value):
+    """ "/Date(1600000000000)/" -> "2020-09-13", or None if the value is no such date """
+    m = DATE_VALUE.match(value)
+    if not m:
+        return None
+    unixtimestamp = int(m.group(1)) / 1000
+    return datetime.fromtimestamp(unixtimestamp).strftime('%Y-%m-%d')
+
+
+def clean_string(value):
+    return value.replace("\n", " ").replace("\r", "").replace(",", " ")
+
+
+class AnlagenCsvWriter:
+    """
+    Keeps the CSV file open for the whole export and converts every page column by column:
+    the date columns are found once per page, and only their values are converted.
+    """
+
+    def __init__(self, outfile_name, drop_columns=(), clean_strings=False):
+        self.outfile_name = outfile_name
+        self.drop_columns = set(drop_columns)
+        self.clean_strings = clean_strings
+        self.outfile = None
+        self.outwriter = None
+        self.fieldnames = None
+        self.row_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.outfile:
+            self.outfile.close()
+            self.outfile = None
+            logging.info("Wrote %s rows to %s", self.row_count, self.outfile_name)
+
+    def write_page(self, anlagen):
+        if not anlagen:
+            return
+
+        # header row from the first page
+        if not self.outwriter:
+            self.fieldnames = [key for key in anlagen[0].keys() if key not in self.drop_columns]
+            self.outfile = open(self.outfile_name, 'w', newline='', encoding='utf-8')
+            self.outwriter = csv.writer(self.outfile, quoting=csv.QUOTE_MINIMAL)
+            self.outwriter.writerow(self.fieldnames)
+
+        columns = {}
+        for key in self.fieldnames:
+            values = [anlage.get(key) for anlage in anlagen]
+            if key != "AnlagenbetreiberName":
+                values = self.convert_column(values)
+            columns[key] = values
+
+        # Anonymize the data of non-stadt-münster-Organisations
+        if "AnlagenbetreiberName" in columns:
+            operators = columns["AnlagenbetreiberName"]
+            unit_names = columns.get("EinheitName")
+            for index, operator in enumerate(operators):
+                if isinstance(operator, str) and not PUBLIC_OPERATOR.search(operator):
+                    operators[index] = ""
+                    if unit_names:
+                        unit_names[index] = ""
+
+        self.outwriter.writerows(zip(*columns.values()))
+        self.row_count += len(anlagen)
+
+    def convert_column(self, values):
+        """ Convert "/Date(...)/" values to dates, if the column contains such dates, and clean all other strings """
+        is_date_column = any(isinstance(value, str) and value.startswith(DATE_PREFIX) for value in values)
+        if not (is_date_column or self.clean_strings):
+            return values
+
+        converted = []
+        for value in values:
+            if isinstance(value, str):
+                date = convert_date(value) if is_date_column and value.startswith(DATE_PREFIX) else None
+                if date:
+                    value = date
+                elif self.clean_strings:
+                    value = clean_string(value)
+            converted.append(value)
+        return converted
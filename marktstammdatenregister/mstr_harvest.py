@@ -0,0 +1,35 @@
+# -*- coding: UTF-8 -*-
+""" Load all result pages of a MaStR query, every page only once """
+
+import re
+import math
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of pages that are requested at the same time
+# (url_cache keeps the requests to the MaStR server at least 1 second apart)
+PARALLEL_REQUESTS = 3
+
+
+def load_all_pages(url_without_pagination, read_url):
+    """ Read page 1, compute the number of pages from its 'Total' and load the other pages in parallel.
+        read_url is the loader's cached url reader. Returns the 'Data' lists of all pages, in page order. """
+    page_size = int(re.search(r"pageSize=(\d+)", url_without_pagination).group(1))
+
+    first_page = read_url(url_without_pagination + '&page=1')
+    total = int(first_page.get('Total') or 0)
+    page_count = math.ceil(total / page_size)
+    logging.info("Anlagen gesamt: %s (%s pages)", total, page_count)
+    if page_count < 1:
+        return []
+
+    page_urls = [url_without_pagination + '&page=' + str(pagenr) for pagenr in range(2, page_count + 1)]
+    with ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS) as executor:
+        other_pages = list(executor.map(read_url, page_urls))
+
+    pages = []
+    for pagenr, page in enumerate([first_page, *other_pages], start=1):
+        anlagen = page.get('Data') or []
+        logging.info("Page %s: %s Anlagen", pagenr, len(anlagen))
+        pages.append(anlagen)
+    return pages
@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+""" Shared part of the MaStR loaders: sync the local store and write the csv and json files """
+
+import re
+import json
+import random
+import logging
+import pprint
+import pyfiglet
+
+import url_cache
+import mstr_aggregation
+import mstr_csv
+import mstr_store
+
+# The store is synced from fresh pages, cached pages are only reused when a run is repeated soon after
+CACHE_MAX_AGE = 60 * 60
+
+# Page size of the full sync
+PAGE_SIZE = 5000
+# Date of the last change of a unit, the incremental sync pages through the units sorted by it
+UPDATE_FIELD = 'DatumLetzteAktualisierung'
+INCREMENTAL_PAGE_SIZE = 100
+# A full sync also removes units that are no longer in the query result
+FULL_SYNC_DAYS = 7
+
+
+def source_urls(base_url, sort_field, source_filter):
+    """ Query urls without the page parameter: [all units sorted by sort_field, units sorted by their last update] """
+    return [
+        base_url + 'sort=' + sort_field + '-desc&pageSize=' + str(PAGE_SIZE) + source_filter,
+        base_url + 'sort=' + UPDATE_FIELD + '-desc&pageSize=' + str(INCREMENTAL_PAGE_SIZE) + source_filter,
+    ]
+
+
+def write_json_file(data, outfile_name):
+    with open(outfile_name, "w", encoding='utf-8') as outfile:
+        json.dump(data, outfile, ensure_ascii=True, indent=2, sort_keys=True)
+
+
+def save(base_url, sort_field, source_filter, store_file, aggregation, complete_csv_file, csv_exports, csv_options=None):
+    """
+    Update the local store of all units, collect the values of all Energieträger in one pass and write the csv and json files.
+    csv_exports: file name -> condition on the indexed columns of the store (see mstr_store.INDEXED_FIELDS),
+    csv_options: keyword arguments of mstr_csv.AnlagenCsvWriter
+    """
+    # Nicer log files with random fonts
+    headline_font = random.choice(pyfiglet.FigletFont.getFonts())
+    logging.debug("(headline font = '%s')", headline_font)
+    custom_fig = pyfiglet.Figlet(font=headline_font, width=120)
+    logging.info("\n%s", custom_fig.renderText("MaStR"))
+
+    def read_url_with_cache(url):
+        filename = 'cache/{}'.format(re.sub("[^0-9a-zA-Z]+", "_", url.replace(base_url, "")))
+        return url_cache.read_json_with_cache(url, filename, CACHE_MAX_AGE)
+
+    def write_csv_file(anlagen, outfile_name):
+        with mstr_csv.AnlagenCsvWriter(outfile_name, **(csv_options or {})) as csv_writer:
+            csv_writer.write_page(anlagen)
+
+    source_url, incremental_url = source_urls(base_url, sort_field, source_filter)
+    db = mstr_store.open_store(store_file)
+    anlagen = mstr_store.sync(
+        db, source_url, incremental_url, read_url_with_cache, UPDATE_FIELD, sort_field, FULL_SYNC_DAYS
+    )
+
+    results = mstr_aggregation.aggregate([anlagen], aggregation)
+
+    if complete_csv_file:
+        write_csv_file(anlagen, complete_csv_file)
+
+    for csv_file, (where, params) in csv_exports.items():
+        write_csv_file(mstr_store.load_units(db, where, params), csv_file)
+    db.close()
+
+    for energy_type, accumulated_results in results.items():
+        write_json_file(accumulated_results, f"anlagen_{energy_type.lower().replace(' ', '_')}.json")
+        logging.info("%s: %s", energy_type, pprint.pformat(accumulated_results))
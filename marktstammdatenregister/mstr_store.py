@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+Local store of the MaStR units (sqlite), keyed by MaStRNummer
+
+A full sync loads all pages of the query and replaces the store. An incremental sync pages through
+the units sorted by their last update and stops as soon as it reaches units that are older
+than the last sync, so only the changed units are requested and updated.
+
+Some fields are also stored in indexed columns, so derived exports (e.g. all Speicher, or the units
+of the Stadtverwaltung) are queries against the store instead of scans over the CSV files.
+"""
+
+import re
+import json
+import time
+import sqlite3
+import logging
+
+import mstr_harvest
+
+ONE_DAY = 60 * 60 * 24
+DATE_VALUE = re.compile(r"/Date\((-?\d+)\)/")
+
+# Indexed columns of the units table, and the MaStR field they are filled from
+INDEXED_FIELDS = {
+    "energietraeger": "EnergietraegerName",
+    "betriebsstatus": "BetriebsStatusName",
+    "betreiber_mastr_nummer": "AnlagenbetreiberMaStRNummer",
+}
+
+# Increase when the table layout changes, older stores are then rebuilt by a full sync
+STORE_VERSION = 2
+
+
+def open_store(filename):
+    db = sqlite3.connect(filename)
+    if db.execute("PRAGMA user_version").fetchone()[0] != STORE_VERSION:
+        logging.info("New store (layout version %s): %s", STORE_VERSION, filename)
+        db.execute("DROP TABLE IF EXISTS units")
+        db.execute("DROP TABLE IF EXISTS sync_state")
+        db.execute(f"PRAGMA user_version = {STORE_VERSION}")
+
+    indexed_columns = "".join(f", {column} TEXT" for column in INDEXED_FIELDS)
+    db.execute(f"CREATE TABLE IF NOT EXISTS units (mastr_nummer TEXT PRIMARY KEY, updated INTEGER, sort_key INTEGER{indexed_columns}, data TEXT)")
+    for column in INDEXED_FIELDS:
+        db.execute(f"CREATE INDEX IF NOT EXISTS units_{column} ON units ({column})")
+    db.execute("CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)")
+    return db
+
+
+def date_ms(value):
+    """ "/Date(1600000000000)/" -> 1600000000000, 0 for missing dates """
+    m = DATE_VALUE.match(value) if isinstance(value, str) else None
+    return int(m.group(1)) if m else 0
+
+
+def get_state(db, name, default=None):
+    row = db.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else default
+
+
+def set_state(db, name, value):
+    db.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, str(value)))
+
+
+def upsert_units(db, anlagen, update_field, sort_field):
+    """ Insert new units and update the changed ones, returns the number of changed rows """
+    columns = ["updated", "sort_key", *INDEXED_FIELDS, "data"]
+    changes_before = db.total_changes
+    db.executemany(
+        f"INSERT INTO units (mastr_nummer, {', '.join(columns)}) VALUES (?{', ?' * len(columns)}) "
+        f"ON CONFLICT (mastr_nummer) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in columns)} "
+        "WHERE units.data != excluded.data",
+        [
+            (
+                anlage['MaStRNummer'], date_ms(anlage.get(update_field)), date_ms(anlage.get(sort_field)),
+                *(anlage.get(field) for field in INDEXED_FIELDS.values()),
+                json.dumps(anlage, ensure_ascii=False)
+            )
+            for anlage in anlagen
+        ]
+    )
+    return db.total_changes - changes_before
+
+
+def first_seen(anlagen, seen_ids):
+    """ Units that are listed on more than one page are only taken from the first one """
+    unique = []
+    for anlage in anlagen:
+        if anlage['MaStRNummer'] not in seen_ids:
+            seen_ids.add(anlage['MaStRNummer'])
+            unique.append(anlage)
+    return unique
+
+
+def load_units(db, where="", params=()):
+    """ All units (or the units matching the where clause on the indexed columns), in the order of the original query """
+    if where:
+        where = "WHERE " + where
+    return [json.loads(data) for (data,) in db.execute(f"SELECT data FROM units {where} ORDER BY sort_key DESC, rowid", params)]
+
+
+def sync(db, source_url, incremental_url, read_url, update_field, sort_field, full_sync_days):
+    """
+    Update the store from the MaStR and return all units.
+    source_url: query sorted by sort_field, incremental_url: the same query sorted by update_field (descending),
+    both without the page parameter. A full sync is done at least every full_sync_days days,
+    so units that have been removed from the register also disappear from the store.
+    read_url must return current pages (its cache max age has to be far below full_sync_days),
+    because the full sync replaces all units with the content of the pages.
+    """
+    watermark = int(get_state(db, 'watermark', 0))
+    last_full_sync = float(get_state(db, 'last_full_sync', 0))
+    seen_ids = set()
+
+    if not watermark or time.time() - last_full_sync > full_sync_days * ONE_DAY:
+        logging.info("FULL SYNC (last full sync: %s)", time.ctime(last_full_sync))
+        pages = mstr_harvest.load_all_pages(source_url, read_url)
+        db.execute("DELETE FROM units")
+        new_watermark = 0
+        for anlagen in pages:
+            upsert_units(db, first_seen(anlagen, seen_ids), update_field, sort_field)
+            new_watermark = max([new_watermark, *(date_ms(anlage.get(update_field)) for anlage in anlagen)])
+        set_state(db, 'last_full_sync', time.time())
+        if not new_watermark:
+            logging.warning("Units have no '%s', incremental sync is not possible", update_field)
+
+    else:
+        logging.info("INCREMENTAL SYNC of units updated since %s", time.ctime(watermark / 1000))
+        new_watermark = watermark
+        pagenr = 1
+        while True:
+            anlagen = read_url(incremental_url + '&page=' + str(pagenr)).get('Data')
+            if not anlagen:
+                break
+            changed = upsert_units(db, first_seen(anlagen, seen_ids), update_field, sort_field)
+            updated = [date_ms(anlage.get(update_field)) for anlage in anlagen]
+            new_watermark = max(new_watermark, *updated)
+            logging.info("Page %s: %s units, %s changed", pagenr, len(anlagen), changed)
+            if min(updated) < watermark:
+                break
+            pagenr = pagenr + 1
+
+    set_state(db, 'watermark', new_watermark)
+    db.commit()
+    return load_units(db)
@@ -1,28 +1,55 @@
 # -*- coding: UTF-8 -*-
 
 import re
+import io
 import json
+import hashlib
 import logging
-import requests
 import os.path
-import time
 import csv
 import os
 
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
 from icalendar import Calendar, Event, vCalAddress, vText
 import pytz
 
+import url_cache
+
 # Config
 OPARL_BASE_URL = 'https://oparl.stadt-muenster.de/'
 OPARL_MEETING_URL = 'https://www.stadt-muenster.de/sessionnet/sessionnetbi/si0057.php?__ksinr={}'
 OUTPUT_FILE_ICS = 'ratsinformation_termine.ics'
 OUTPUT_FILE_CSV = 'ratsinformation_termine.csv'
+# Serialized events of the last run, unchanged meetings are written exactly as before
+STATE_FILE = 'cache/ratsinformation_termine.state.json'
+STATE_VERSION = 1
+CACHE_MAX_AGE = 60*60*24*30
+
+# Number of pages (or organizations) that are requested at the same time
+# (url_cache keeps the requests to the OParl server at least 1 second apart)
+PARALLEL_REQUESTS = 4
+MAX_PAGES = 300
 
 SKIP_EMPTY_ORGANIZATION_NAMES = True
 CONFIG_EXPORT_YEAR = "2024"
 
+# Exported meetings: start date from CONFIG_EXPORT_START (inclusive) to CONFIG_EXPORT_END (exclusive)
+CONFIG_EXPORT_START = CONFIG_EXPORT_YEAR + "-01-01"
+CONFIG_EXPORT_END = str(int(CONFIG_EXPORT_YEAR) + 1) + "-01-01"
+
+# Optional: only request meetings that were created at most this many days before CONFIG_EXPORT_START
+# (OParl "created_since" filter). Fewer pages, but meetings in the export range that were created earlier
+# (e.g. a series planned long in advance) are MISSING in the export. None = request all meetings.
+CONFIG_CREATED_SINCE_MARGIN_DAYS = None
+
+# Optional: set to True only if the server is known to sort the meetings list by start date. Paging then stops
+# at the first page that is completely past the export range. If the list is sorted by something else
+# (id, creation date), meetings on later pages would be MISSING in the export. False = read all pages.
+CONFIG_MEETINGS_SORTED_BY_START = False
+
 
 # Basic logger configuration
 logging.basicConfig(level=logging.DEBUG, format='<%(asctime)s %(levelname)s> %(message)s')
@@ -31,58 +58,111 @@ logging.addLevelName( logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelN
 logging.info("=====> START %s <=====", datetime.now())
 
 
+def loadState():
+    try:
+        with open(STATE_FILE, encoding='utf-8') as statefile:
+            state = json.load(statefile)
+    except (OSError, ValueError):
+        return {}
+    if state.get('version') != STATE_VERSION:
+        return {}
+    return state.get('meetings', {})
+
+
+def saveState(meetings):
+    with open(STATE_FILE + '.tmp', 'w', encoding='utf-8') as statefile:
+        json.dump({'version': STATE_VERSION, 'meetings': meetings}, statefile)
+    os.replace(STATE_FILE + '.tmp', STATE_FILE)
+
+
+def writeIfChanged(filename, content):
+    """ Write the file only if its content changed, so unchanged files keep their timestamp """
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as oldfile:
+            if oldfile.read() == content:
+                logging.info("Unchanged: %s", filename)
+                return
+    with open(filename, 'wb') as outfile:
+        outfile.write(content)
+
+
+def createEvent(session):
+    """
+    Serialized VEVENT and CSV row of a session
+    """
+
+    # Prepare event title (and convert datestrings to datetime objects with timezone)
+    meetingId = session[5]
+    sessionName = session[2]
+    committee = session[3]
+    location = session[4]
+    start = datetime.fromisoformat(session[0])
+    end = datetime.fromisoformat(session[1])
+    meetingUrl = OPARL_MEETING_URL.format(meetingId)
+    logging.info("Adding ical: %s %s %s", start, committee, sessionName)
+
+    # Create ical event (and convert datetimes to UTC)
+    event = Event()
+    event.add('summary', '{} - {}'.format(committee, sessionName))
+    event.add('dtstart', start.astimezone(pytz.utc))
+    event.add('dtend', end.astimezone(pytz.utc))
+    event.add('dtstamp', datetime.now())
+    event.add('description', meetingUrl)
+    event.add('uid', '20220215T101010/{}@ms'.format(meetingId))
+
+    organizer = vCalAddress('MAILTO:opendata@citeq.de')
+    organizer.params['cn'] = vText('Stadt Münster')
+    organizer.params['role'] = vText('Ratsinformationssytem')
+    event['organizer'] = organizer
+    event['location'] = vText(location)
+
+    csvRow = [meetingId, str(start), str(end), committee, sessionName, location, meetingUrl]
+    return event.to_ical().decode('utf-8'), csvRow
+
+
 def writeIcal(calendarItems):
     """
-    Write ICAL and CSV files
+    Write ICAL and CSV files.
+    Every meeting keeps a hash of its values, the events of unchanged meetings (and their dtstamp)
+    are taken from the last run, only new or changed meetings are converted again.
     """
 
     cal = Calendar()
     cal.add('prodid', '-//Gremien Kalender//opendata.stadt-muenster.de//')
     cal.add('version', '2.0')
 
-    with open(OUTPUT_FILE_CSV, 'w', newline='') as csvfile:
-        csvWriter = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        csvWriter.writerow(['MeetingID', 'Start', 'Ende', 'Gremium', 'Veranstaltung', 'Ort', 'Weitere Information'])
+    oldState = loadState()
+    newState = {}
+    vevents = []
 
-        for key, session in sorted(calendarItems.items()):
+    csvfile = io.StringIO(newline='')
+    csvWriter = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    csvWriter.writerow(['MeetingID', 'Start', 'Ende', 'Gremium', 'Veranstaltung', 'Ort', 'Weitere Information'])
 
-            # Prepare event title (and convert datestrings to datetime objects with timezone)
-            meetingId = session[5]
-            sessionName = session[2]
-            committee = session[3]
-            location = session[4]
-            start = datetime.strptime(session[0], "%Y-%m-%dT%H:%M:%S%z")
-            end = datetime.strptime(session[1], "%Y-%m-%dT%H:%M:%S%z")
-            meetingUrl = OPARL_MEETING_URL.format(meetingId)
-            logging.info("Adding ical: %s %s %s", start, committee, sessionName)
+    changed = 0
+    for key, session in sorted(calendarItems.items()):
+        meetingId = str(session[5])
+        sessionHash = hashlib.sha1(json.dumps(session).encode('utf-8')).hexdigest()
 
-            # Create ical event (and convert datetimes to UTC)
-            event = Event()
-            event.add('summary', '{} - {}'.format(committee, sessionName))
-            event.add('dtstart', start.astimezone(pytz.utc))
-            event.add('dtend', end.astimezone(pytz.utc))
-            event.add('dtstamp', datetime.now())
-            event.add('description', meetingUrl)
-            event.add('uid', '20220215T101010/{}@ms'.format(meetingId))
+        meetingState = oldState.get(meetingId)
+        if not meetingState or meetingState['hash'] != sessionHash:
+            vevent, csvRow = createEvent(session)
+            meetingState = {'hash': sessionHash, 'vevent': vevent, 'csv': csvRow}
+            changed = changed + 1
 
-            organizer = vCalAddress('MAILTO:opendata@citeq.de')
-            organizer.params['cn'] = vText('Stadt Münster')
-            organizer.params['role'] = vText('Ratsinformationssytem')
-            event['organizer'] = organizer
-            event['location'] = vText(location)
+        newState[meetingId] = meetingState
+        vevents.append(meetingState['vevent'])
+        csvWriter.writerow(meetingState['csv'])
 
-            # Add event to calendar
-            cal.add_component(event)
+    logging.info("%s new or changed meetings, %s removed", changed, len(oldState.keys() - newState.keys()))
 
-            # Add event to CSV
-            csvWriter.writerow([meetingId, str(start), str(end), committee, sessionName, location, meetingUrl])
-
-
-    # Write ical file
-    f = open(OUTPUT_FILE_ICS, 'wb')
-    f.write(cal.to_ical())
-    f.close()
+    # Write ical file (the events are inserted before the end of the calendar)
+    calendarLines = cal.to_ical().decode('utf-8')
+    endOfCalendar = calendarLines.rindex('END:VCALENDAR')
+    writeIfChanged(OUTPUT_FILE_ICS, (calendarLines[:endOfCalendar] + ''.join(vevents) + calendarLines[endOfCalendar:]).encode('utf-8'))
+    writeIfChanged(OUTPUT_FILE_CSV, csvfile.getvalue().encode('utf-8'))
 
+    saveState(newState)
 
 
 def getDictValueFailsafe(target_dict, keys):
@@ -108,134 +188,176 @@ def getDictValueFailsafe(target_dict, keys):
 def readUrlWithCache(url):
 
     filename = 'cache/{}'.format(re.sub("[^0-9a-zA-Z]+", "_", url.replace(OPARL_BASE_URL, "")))
+    return url_cache.read_json_with_cache(url, filename, CACHE_MAX_AGE)
 
-    currentTS = time.time()
-    cacheMaxAge = 60*60*24*30
-    generateCacheFile = True
-    filecontent = "{}"
-    if os.path.isfile(filename):
-        fileModTime = os.path.getmtime(filename)
-        timeDiff = currentTS - fileModTime
-        if (timeDiff > cacheMaxAge):
-            logging.debug("cache file age %s too old: %s", timeDiff, filename)
-        else:
-            generateCacheFile = False
-            logging.debug("%s - using cache", filename)
-            with open(filename) as myfile:
-                filecontent ="".join(line.rstrip() for line in myfile)
-
-    if generateCacheFile:
-        logging.debug("%s - HTTP GET", filename)
-        req = requests.get(url)
-        if req.status_code > 399:
-            logging.warning('Request result: HTTP %s - %s', req.status_code, url)
 
-        open(filename, 'wb').write(req.content)
-        filecontent = req.text
-        # lets wat a bit, dont kill a public server
-        time.sleep(1)
+def readAllPages(urlTemplate):
+    """
+    Read the pages of a paginated OParl list, PARALLEL_REQUESTS pages at the same time,
+    until the first empty page. Yields the pages (with 'data' and 'pagination') in page order.
+    """
+    with ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS) as executor:
+        for firstPageNr in range(0, MAX_PAGES, PARALLEL_REQUESTS):
+            pageNrs = range(firstPageNr, min(firstPageNr + PARALLEL_REQUESTS, MAX_PAGES))
+            pages = executor.map(readUrlWithCache, [urlTemplate.format(pageNr) for pageNr in pageNrs])
 
-    jsn = json.loads(filecontent)
-    if jsn.get('status') == 404:
-        logging.warning('missing url: %s', url)
-        return json.loads("{}")
-    return jsn
+            for pageNr, page in zip(pageNrs, pages):
+                logging.info("====================> Processing page %s", pageNr)
+                data = page.get('data')
+                if not data:
+                    logging.info("** DONE **")
+                    return
+                yield page
 
 
 def getOrganizations():
+    """ All organizations of the organizations list, by their url """
 
     orgUrlTemplate = OPARL_BASE_URL + 'bodies/0001/organizations?page={}'
     logging.debug("Organziation URL: %s", orgUrlTemplate)
 
     orgList = {}
 
-    for pageNr in range(0, 300):
-        logging.info("====================> Processing page %s", pageNr)
-        organizations  = readUrlWithCache(orgUrlTemplate.format(pageNr)).get('data')
+    for page in readAllPages(orgUrlTemplate):
+        for org in page['data']:
+            logging.info("%s %s %s", org['id'], org['name'], org['shortName'])
+            orgList[org['id']] = org
 
-        if not organizations:
-            logging.info("** DONE **")
-            break
+    return orgList
 
-        for org in organizations:
-            id = org['id']
-            name = org['name']
-            shortName = org['shortName']
-            logging.info("%s %s %s", id, name, shortName)
 
-            orgList[id] = [name, shortName]
+def isInExportRange(start):
+    return CONFIG_EXPORT_START <= start[:10] < CONFIG_EXPORT_END
 
-    return orgList
 
+def parseTimestamp(value):
+    """ OParl timestamp as datetime with timezone (UTC if it has none), None for missing or invalid values """
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
 
-def getGremienList():
 
-    # Read meeting list
+def getMeetings():
+    """
+    All meetings that start in the export range.
+    With CONFIG_MEETINGS_SORTED_BY_START, paging stops as soon as a whole page is past the export range
+    (as long as the pages read so far are sorted by start date).
+    With CONFIG_CREATED_SINCE_MARGIN_DAYS, the meetings list is requested with the OParl "created_since" filter.
+    """
+
     meetingUrlTemplate = OPARL_BASE_URL + 'bodies/0001/meetings?page={}'
+    createdSince = None
+    if CONFIG_CREATED_SINCE_MARGIN_DAYS is not None:
+        createdSince = datetime.fromisoformat(CONFIG_EXPORT_START).replace(tzinfo=timezone.utc) - timedelta(days=CONFIG_CREATED_SINCE_MARGIN_DAYS)
+        meetingUrlTemplate = OPARL_BASE_URL + 'bodies/0001/meetings?created_since=' + quote(createdSince.isoformat()) + '&page={}'
     logging.debug("Meeting URL: %s", meetingUrlTemplate)
 
-    # Because opar from SOMACOS Session is so broken,
-    # we try to use the list of the "organziations" endpoint as a fallback.
-    # .. maybe the missing organization is in there..?
-    # Update: Nope, this doesn't help .. Some organizatinos are not returned via oparl api at all
+    meetings = []
+    filterIgnored = False
+    sortOrder = None   # 1 = ascending, -1 = descending start dates, 0 = not sorted
+    previousStart = None
+
+    pagesRead = 0
+    for page in readAllPages(meetingUrlTemplate):
+        meetingsPage = page['data']
+        pagesRead = pagesRead + 1
+        for meeting in meetingsPage:
+            start = meeting['start']
+
+            created = parseTimestamp(meeting.get('created'))
+            if createdSince and created and created < createdSince and not filterIgnored:
+                logging.info("Server does not support the created_since filter")
+                filterIgnored = True
+
+            if previousStart and start != previousStart and sortOrder != 0:
+                order = 1 if start > previousStart else -1
+                if sortOrder is None:
+                    sortOrder = order
+                elif order != sortOrder:
+                    logging.info("Meetings are not sorted by start date")
+                    sortOrder = 0
+            previousStart = start
+
+            if not isInExportRange(start):
+                logging.debug("out of range %s", start)
+                continue
+            meetings.append(meeting)
+
+        # Meetings sorted by start date: all later pages are out of range too
+        if not CONFIG_MEETINGS_SORTED_BY_START:
+            continue
+        starts = [meeting['start'][:10] for meeting in meetingsPage]
+        if (sortOrder == 1 and min(starts) >= CONFIG_EXPORT_END) or (sortOrder == -1 and max(starts) < CONFIG_EXPORT_START):
+            totalPages = page.get('pagination', {}).get('totalPages')
+            logging.info("** DONE ** after %s pages, skipping %s following pages (out of the export range)",
+                         pagesRead, totalPages - pagesRead if totalPages else "the")
+            break
+
+    return meetings
+
+
+def getGremienList():
+
+    # Every organization is requested only once: the organizations of the "organizations" endpoint
+    # are used as they are, the other organizations of the meetings are requested (in parallel) and added.
+    # Because opar from SOMACOS Session is so broken, the org url of a meeting can still fail:
+    # Some organizatinos are not returned via oparl api at all
     orgList = getOrganizations()
 
-    calendar = {}
+    meetings = getMeetings()
 
-    for pageNr in range(0, 300):
-        logging.info("====================> Processing page %s", pageNr)
-        meetingUrl = meetingUrlTemplate.format(pageNr)
-        meetingsJson = readUrlWithCache(meetingUrl)
-        meetings = meetingsJson.get('data')
+    missingOrgUrls = set()
+    for meeting in meetings:
+        orgUrl = getDictValueFailsafe(meeting, ['organization', 0])
+        if orgUrl and orgUrl.startswith(OPARL_BASE_URL) and orgUrl not in orgList:
+            missingOrgUrls.add(orgUrl)
 
-        if not meetings:
-            logging.info("** DONE **")
-            break
+    logging.info("Reading %s organizations that are not in the organizations list", len(missingOrgUrls))
+    with ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS) as executor:
+        orgList.update(zip(missingOrgUrls, executor.map(readUrlWithCache, missingOrgUrls)))
 
-        for meeting in meetings:
-            name = meeting['name']
-            start = meeting['start']
-            end = meeting['end']
-            room = getDictValueFailsafe(meeting, ['location', 'room'])
-            orgUrl = getDictValueFailsafe(meeting, ['organization', 0])
-            # Parse numeric meeting ID from meeting url (url is in field "id")
-            meetingId = re.search("/(\d+)$", meeting['id']).group(1)
-            orgName = ""
-
-            if not start.startswith(CONFIG_EXPORT_YEAR):
-                logging.debug("wrong year %s", start)
-                continue
+    calendar = {}
 
-            elif not orgUrl:
-                logging.warning("empty 'organisation' field")
+    for meeting in meetings:
+        name = meeting['name']
+        start = meeting['start']
+        end = meeting['end']
+        room = getDictValueFailsafe(meeting, ['location', 'room'])
+        orgUrl = getDictValueFailsafe(meeting, ['organization', 0])
+        # Parse numeric meeting ID from meeting url (url is in field "id")
+        meetingId = re.search(r"/(\d+)$", meeting['id']).group(1)
+        orgName = ""
 
-            elif not orgUrl.startswith(OPARL_BASE_URL):
-                logging.warning("invalid 'organisation' url %s", orgUrl)
+        if not orgUrl:
+            logging.warning("empty 'organisation' field")
+
+        elif not orgUrl.startswith(OPARL_BASE_URL):
+            logging.warning("invalid 'organisation' url %s", orgUrl)
+
+        else:
+            org = orgList[orgUrl]
+            if not org:
+                # This should not happen at all and is validation of oparl specification
+                # But sadly, this happens a lot with
+                logging.warning("organisation url failed - %s", start)
+                if not SKIP_EMPTY_ORGANIZATION_NAMES:
+                    logging.warning("organization not in org list")
+                    orgName = 'Gremium "{}"'.format(orgUrl.replace(OPARL_BASE_URL, ''))
 
             else:
-                org = readUrlWithCache(orgUrl)
-                if not org:
-                    # This should not happen at all and is validation of oparl specification
-                    # But sadly, this happens a lot with
-                    logging.warning("organisation url failed - %s", start)
-                    if orgUrl in orgList:
-                        orgName = orgList[orgUrl][0]
-                    elif not SKIP_EMPTY_ORGANIZATION_NAMES:
-                        logging.warning("organization not in org list")
-                        orgName = 'Gremium "{}"'.format(orgUrl.replace(OPARL_BASE_URL, ''))
-
-                else:
-                    organisation = org.get('name')
-                    orgShortName = org.get('shortName')
-                    #members = len(org.get('membership'))
-                    #startDate = org.get('startDate')
-                    orgName = organisation if organisation else orgShortName
-
-            if orgName:
-                logging.info('%s - %s | %s - %s',start, orgName, name, room)
-                calendar[start + str(meetingId)] = [start, end, name, orgName, room, meetingId]
-            else:
-                logging.warning("%s - skipping event, empty organziation name", start)
+                organisation = org.get('name')
+                orgShortName = org.get('shortName')
+                #members = len(org.get('membership'))
+                #startDate = org.get('startDate')
+                orgName = organisation if organisation else orgShortName
+
+        if orgName:
+            logging.info('%s - %s | %s - %s',start, orgName, name, room)
+            calendar[start + str(meetingId)] = [start, end, name, orgName, room, meetingId]
+        else:
+            logging.warning("%s - skipping event, empty organziation name", start)
 
     for key, value in sorted(calendar.items()):
         logging.info("%s %s", key, value)
@@ -7,7 +7,7 @@ And saves them as geojson and csv
 
 import os
 import re
-import time
+import sys
 import csv
 import json
 import random
@@ -16,7 +16,11 @@ from datetime import datetime
 import pyfiglet
 import requests
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import url_cache  # pylint: disable=wrong-import-position
+
 START_URL = 'https://www.netzplan-muenster.de'
+CACHE_MAX_AGE = 60 * 60 * 24 * 30
 
 URLS = {
 
@@ -57,61 +61,31 @@ def readUrlWithCache(cachefile_name, url):
     global CSRF_TOKEN
     filename = f'{cachefile_name}.json'
 
-    currentTS = time.time()
-    cache_max_age = 60 * 60 * 24 * 30
-    generate_cache_file = True
-    filecontent = "{}"
-    if os.path.isfile(filename):
-        fileModTime = os.path.getmtime(filename)
-        timeDiff = currentTS - fileModTime
-        if (timeDiff > cache_max_age):
-            logging.debug("# CACHE file age %s too old: %s", timeDiff, filename)
+    if not url_cache.is_fresh(filename, CACHE_MAX_AGE) and not SESSION_IS_INITIALIZED:
+        logging.debug("Fetching START_URL: %s", START_URL)
+        response = SESSION.get(START_URL, headers=HEADERS)
+        logging.debug("Status: %s", response.status_code)
+        matchobj = re.search(r'<meta\s+name="csrf-token"\s+content="([^"]+)">', str(response.content))
+        if matchobj:
+            CSRF_TOKEN = matchobj.group(1)
+            logging.debug("Got CSRF_TOKEN %s", CSRF_TOKEN)
         else:
-            generate_cache_file = False
-            logging.debug("(using cached file instead of url get)")
-            with open(filename) as myfile:
-                filecontent = "".join(line.rstrip() for line in myfile)
-
-    if generate_cache_file:
-        if not SESSION_IS_INITIALIZED:
-            logging.debug("Fetching START_URL: %s", START_URL)
-            response = SESSION.get(START_URL, headers=HEADERS)
-            logging.debug("Status: %s", response.status_code)
-            matchobj = re.search(r'<meta\s+name="csrf-token"\s+content="([^"]+)">', str(response.content))
-            if matchobj:
-                CSRF_TOKEN = matchobj.group(1)
-                logging.debug("Got CSRF_TOKEN %s", CSRF_TOKEN)
-            else:
-                logging.warning("Did not find CSRF_TOKEN")
-
-            SESSION_IS_INITIALIZED = True
-            logging.debug("--------- COOKIE ----------")
-            print(SESSION.cookies.get_dict())
-
-        logging.debug("# URL HTTP GET %s ", filename)
-        HEADERS2 = {
-            "Referer": "https://www.netzplan-muenster.de/",
-            "X-CSRF-TOKEN": CSRF_TOKEN,
-            'Accept':'application/json, text/plain, */*',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br, zstd',
-            'X-Requested-With': 'XMLHttpRequest',
-        }
-        HEADERS2.update(HEADERS)
-        req = SESSION.get(url, headers=HEADERS2)
-        if req.status_code > 399:
-            logging.error('  - Request result: HTTP %s - %s', req.status_code, req)
-            raise FileNotFoundError
-
-        open(filename, 'wb').write(req.content)
-        filecontent = req.text
-        time.sleep(1)
-
-    jsn = json.loads(filecontent)
-    if jsn.get('status') == 404:
-        logging.warning('  - missing url: %s', url)
-        return json.loads("{}")
-    return jsn
+            logging.warning("Did not find CSRF_TOKEN")
+
+        SESSION_IS_INITIALIZED = True
+        logging.debug("--------- COOKIE ----------")
+        print(SESSION.cookies.get_dict())
+
+    HEADERS2 = {
+        "Referer": "https://www.netzplan-muenster.de/",
+        "X-CSRF-TOKEN": CSRF_TOKEN,
+        'Accept':'application/json, text/plain, */*',
+        'Accept-Language': 'en-US,en;q=0.5',
+        'Accept-Encoding': 'gzip, deflate, br, zstd',
+        'X-Requested-With': 'XMLHttpRequest',
+    }
+    HEADERS2.update(HEADERS)
+    return url_cache.read_json_with_cache(url, filename, CACHE_MAX_AGE, session=SESSION, headers=HEADERS2, raise_on_error=True)
 
 
 def main():
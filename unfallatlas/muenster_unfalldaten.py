@@ -5,16 +5,22 @@
 # -*- coding: UTF-8 -*-
 
 import re
+import io
 import csv
-import time
+import sys
+import gzip
+import json
+import hashlib
 import random
 import logging
 import os
 from datetime import datetime, timezone, timedelta
-import requests
 import pyfiglet
 import zipfile
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import url_cache  # pylint: disable=wrong-import-position
+
 
 # Basic logger configuration
 logging.basicConfig(level=logging.DEBUG, format='<%(asctime)s %(levelname)s> %(message)s')
@@ -32,24 +38,87 @@ logging.debug("(headline font = '%s')", HEADLINE_FONT)
 CACHEDIR = 'cache/'
 BASE_URL = 'https://www.opengeodata.nrw.de/produkte/transport_verkehr/unfallatlas/'
 BASEFILE = 'Unfallorte{}_EPSG25832_CSV.zip'
-FILES = [
-    'Unfallorte2016_LinRef.txt', 'Unfallorte2017_LinRef.txt',  #'Unfallorte2021_EPSG25832_CSV.csv' ,
-    'Unfallorte2018_LinRef.txt', 'Unfallorte2019_LinRef.txt', 'Unfallorte2020_LinRef.csv',
-    'Unfallorte2021_LinRef.csv', 'Unfallorte2022_LinRef.csv', 'Unfallorte2023_LinRef.csv'
-]
+CACHE_MAX_AGE = 60 * 60 * 24 * 365
+# Years from FIRST_YEAR to last year are loaded, years that are not published (yet) are skipped
+FIRST_YEAR = 2016
+# CSV file inside the zip of a year, e.g. 'csv/Unfallorte2016_LinRef.txt' or 'csv/Unfallorte2020_LinRef.csv'
+CSV_MEMBER_NAME = re.compile(r"Unfallorte(\d{4})\w*_LinRef\.(csv|txt)$", re.IGNORECASE)
 OUTPUT_FILE = 'unfaelle-muenster.csv'
 
+# GeoJSON files for the map: one file per Kreis, and an index with the bounding box of every file
+GEOJSON_DIR = 'geojson/'
+GEOJSON_FILE = 'unfaelle-kreis-{}.geojson'
+GEOJSON_INDEX_FILE = 'unfaelle-index.json'
+# UKREIS in Regierungsbezirk Münster (see table below)
+KREIS_NAMES = {
+    '12': 'Bottrop', '13': 'Gelsenkirchen', '15': 'Münster', '54': 'Borken',
+    '58': 'Coesfeld', '62': 'Recklinghausen', '66': 'Steinfurt', '70': 'Warendorf',
+}
+
 
-# the following is currently unused, still maybe interesting
-fileformats = {
-    2016: 'FID;OBJECTID;ULAND;UREGBEZ;UKREIS;UGEMEINDE;UJAHR;UMONAT;USTUNDE;UWOCHENTAG;UKATEGORIE;UART;UTYP1;ULICHTVERH;IstStrasse;IstRad;IstPKW;IstFuss;IstKrad;IstGkfz;IstSonstig;LINREFX;LINREFY;XGCSWGS84;YGCSWGS84',
-    # 0;1;01;0;53;120;2016;01;09;5;2;8;1;0;2;0;1;0;0;0;0;606982,393999999970000;5954659,924999999800000;10,621659329000000;53,729614888000000
-    2017: 'OBJECTID;UIDENTSTLA;ULAND;UREGBEZ;UKREIS;UGEMEINDE;UJAHR;UMONAT;USTUNDE;UWOCHENTAG;UKATEGORIE;UART;UTYP1;IstRad;IstPKW;IstFuss;IstKrad;IstSonstig;LICHT;STRZUSTAND;LINREFX;LINREFY;XGCSWGS84;YGCSWGS84',
-    # 1;01170113152013852017;01;0;55;012;2017;01;05;6;2;9;1;0;1;0;0;0;2;2;605079,422900000010000;6001757,554700000200000;10,609031240000036;54,153150062000066
-    2018: 'OBJECTID_1;ULAND;UREGBEZ;UKREIS;UGEMEINDE;UJAHR;UMONAT;USTUNDE;UWOCHENTAG;UKATEGORIE;UART;UTYP1;ULICHTVERH;IstRad;IstPKW;IstFuss;IstKrad;IstGkfz;IstSonstig;STRZUSTAND;LINREFX;LINREFY;XGCSWGS84;YGCSWGS84'
-    # 1;01;0;03;000;2018;01;08;5;2;0;7;0;1;0;0;0;0;0;0;612054,341999999950000;5969634,006000000100000;10,703950299000041;53,863081147000059
 
+def to_code(value):
+    """ Codes and counts (Land, Kreis, Monat, ...) are written as in the source, with their leading zeros """
+    return value
+
+
+def to_decimal(value):
+    """ German decimal comma, the digits are kept: "606982,393999999970000" -> "606982.393999999970000" """
+    return value.replace(',', '.')
+
+
+# Fields of the result file: the names of the column in the yearly files (the first one found is used)
+# and the converter of the values. Names that changed over time are listed here for all years.
+# Typed int/float columns were deliberately dropped: the values are kept as in the source (e.g. "01") and only
+# the decimal comma is replaced, so the csv file stays byte-identical. to_code is the hook for a field that
+# needs a real conversion. The GeoJSON coordinates are parsed in add_features.
+FIELD_SCHEMA = {
+    'ULAND': (['ULAND'], to_code),
+    'UREGBEZ': (['UREGBEZ'], to_code),
+    'UKREIS': (['UKREIS'], to_code),
+    'UGEMEINDE': (['UGEMEINDE'], to_code),
+    'UJAHR': (['UJAHR'], to_code),
+    'UMONAT': (['UMONAT'], to_code),
+    'USTUNDE': (['USTUNDE'], to_code),
+    'UWOCHENTAG': (['UWOCHENTAG'], to_code),
+    'UKATEGORIE': (['UKATEGORIE'], to_code),
+    'UART': (['UART'], to_code),
+    'UTYP1': (['UTYP1'], to_code),
+    'ULICHTVERH': (['ULICHTVERH'], to_code),
+    'IstRad': (['IstRad'], to_code),
+    'IstPKW': (['IstPKW'], to_code),
+    'IstFuss': (['IstFuss'], to_code),
+    'IstKrad': (['IstKrad'], to_code),
+    'IstGkfz': (['IstGkfz'], to_code),
+    'IstSonstige': (['IstSonstig', 'IstSonstige'], to_code),
+    'LINREFX': (['LINREFX'], to_decimal),
+    'LINREFY': (['LINREFY'], to_decimal),
+    'XGCSWGS84': (['XGCSWGS84'], to_decimal),
+    'YGCSWGS84': (['YGCSWGS84'], to_decimal),
+    'STRZUSTAND': (['USTRZUSTAND', 'IstStrassenzustand', 'STRZUSTAND'], to_code),
+    'UIDENTSTLAE': (['UIDENTSTLAE'], to_code),
 }
+WANTED_FIELDS = list(FIELD_SCHEMA)
+
+# Columns that only one year calls differently: year -> {column name in the file: field of the result file}
+# Headers of the early files, for reference:
+# 2016: FID;OBJECTID;ULAND;UREGBEZ;UKREIS;UGEMEINDE;UJAHR;UMONAT;USTUNDE;UWOCHENTAG;UKATEGORIE;UART;UTYP1;ULICHTVERH;IstStrasse;IstRad;IstPKW;IstFuss;IstKrad;IstGkfz;IstSonstig;LINREFX;LINREFY;XGCSWGS84;YGCSWGS84
+# 2017: OBJECTID;UIDENTSTLA;ULAND;UREGBEZ;UKREIS;UGEMEINDE;UJAHR;UMONAT;USTUNDE;UWOCHENTAG;UKATEGORIE;UART;UTYP1;IstRad;IstPKW;IstFuss;IstKrad;IstSonstig;LICHT;STRZUSTAND;LINREFX;LINREFY;XGCSWGS84;YGCSWGS84
+# 2018: OBJECTID_1;ULAND;UREGBEZ;UKREIS;UGEMEINDE;UJAHR;UMONAT;USTUNDE;UWOCHENTAG;UKATEGORIE;UART;UTYP1;ULICHTVERH;IstRad;IstPKW;IstFuss;IstKrad;IstGkfz;IstSonstig;STRZUSTAND;LINREFX;LINREFY;XGCSWGS84;YGCSWGS84
+YEAR_SCHEMAS = {
+    2017: {'UIDENTSTLA': 'UIDENTSTLAE', 'LICHT': 'ULICHTVERH'},
+}
+
+# Only rows of Land NRW (05), Regierungsbezirk Münster (5) are written
+WANTED_ULAND = '5'
+WANTED_UREGBEZ = '5'
+
+# The filtered rows of every year are kept column by column in a gzipped json file,
+# together with the hash of the zip they come from. Only new or changed zips are parsed again.
+PARTITION_DIR = CACHEDIR + 'partitions/'
+PARTITION_FILE = 'unfaelle-{}.json.gz'
+# Increase when the filtering or the fields change, all partitions are then parsed again
+PARTITION_VERSION = 3
 
 
 # Daten 2021
@@ -73,60 +142,195 @@ def big_debug_text(text):
 
 
 def downloadFileToCache(url):
-    """ repeated runs of this script will use the same cache file for 1 month """
+    """ repeated runs of this script will use the same cache file for 1 year,
+        returns the filename of the cache file, or "" if the url is missing """
 
     filename = CACHEDIR + '{}'.format(re.sub("[^0-9a-zA-Z._]+", "_", url.replace(BASE_URL, "")))
-
-    currentTS = time.time()
-    cacheMaxAge = 60 * 60 * 24 * 365
-    generateCacheFile = True
-    filecontent = "{}"
-    if os.path.isfile(filename):
-        fileModTime = os.path.getmtime(filename)
-        timeDiff = currentTS - fileModTime
-        if timeDiff > cacheMaxAge:
-            logging.debug("# CACHE file age %s too old: %s", timeDiff, filename)
-        else:
-            generateCacheFile = False
-            filename = ""
-            logging.debug("(using cached file instead of url get)")
-
-    if generateCacheFile:
-        logging.debug("# URL HTTP GET %s ", filename)
-        req = requests.get(url, timeout=120)
-        if req.status_code > 399:
-            logging.warning('  - Request result: HTTP %s - %s', req.status_code, url)
-
-        open(filename, 'wb').write(req.content)
-        time.sleep(1)
-
+    try:
+        url_cache.download_with_cache(url, filename, CACHE_MAX_AGE, raise_on_error=True)
+    except FileNotFoundError:
+        return ""
     return filename
 
 
-def download_and_unzip_data():
-    for year in range(2016, 2024):
+def download_data():
+    """ returns the cached zip files of all years """
+    zipfiles = {}
+    for year in range(FIRST_YEAR, datetime.now().year):
         big_debug_text(f"Load {year}")
 
         fileurl = BASE_URL + BASEFILE.format(year)
         filename = downloadFileToCache(fileurl)
         if filename:
-            with zipfile.ZipFile(filename, 'r') as zip_ref:
-                zip_ref.extractall(CACHEDIR)
-
-
-def combine_csv_files():
+            zipfiles[year] = filename
+        else:
+            logging.warning("No data for %s", year)
+    return zipfiles
+
+
+def find_csv_member(zip_ref, year):
+    """ name of the csv file of the year inside the zip file """
+    for name in zip_ref.namelist():
+        m = CSV_MEMBER_NAME.search(name)
+        if m and int(m.group(1)) == year:
+            return name
+    return None
+
+
+def compile_schema(header, year):
+    """ (column index, converter) for every field in WANTED_FIELDS, the index is None for missing fields """
+    columns = {name: index for index, name in enumerate(header)}
+    for name, field in YEAR_SCHEMAS.get(year, {}).items():
+        if name in columns:
+            columns.setdefault(field, columns[name])
+
+    schema = []
+    for field, (names, converter) in FIELD_SCHEMA.items():
+        index = next((columns[name] for name in names if name in columns), None)
+        schema.append((index, converter))
+    return schema
+
+
+def is_code(value, code):
+    """ Compare the code with a raw csv value without int() conversion, e.g. "05" or "5" """
+    return value == code or value.strip().lstrip('0') == code
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_partition(year, source_hash):
+    """ the cached columns of a year, or None if there are none for this zip file """
+    try:
+        with gzip.open(PARTITION_DIR + PARTITION_FILE.format(year), 'rt', encoding='utf-8') as partfile:
+            partition = json.load(partfile)
+    except (OSError, ValueError):
+        return None
+    if partition.get('version') != PARTITION_VERSION or partition.get('source_hash') != source_hash or partition.get('fields') != WANTED_FIELDS:
+        return None
+    return partition['columns']
+
+
+def save_partition(year, source_hash, columns):
+    os.makedirs(PARTITION_DIR, exist_ok=True)
+    filename = PARTITION_DIR + PARTITION_FILE.format(year)
+    partition = {'version': PARTITION_VERSION, 'source_hash': source_hash, 'fields': WANTED_FIELDS, 'columns': columns}
+    with gzip.open(filename + '.tmp', 'wt', encoding='utf-8') as partfile:
+        json.dump(partition, partfile, ensure_ascii=False, separators=(',', ':'))
+    os.replace(filename + '.tmp', filename)
+
+
+def read_year(zipfilename, year, filenr):
+    """ Read the csv file directly from the zip file, returns the columns of the rows of Regierungsbezirk Münster """
+    try:
+        zip_ref = zipfile.ZipFile(zipfilename, 'r')
+    except zipfile.BadZipFile:
+        logging.warning("Invalid zip file for %s: %s", year, zipfilename)
+        return None
+
+    file = find_csv_member(zip_ref, year)
+    if not file:
+        logging.warning("No csv file for %s in %s: %s", year, zipfilename, zip_ref.namelist())
+        zip_ref.close()
+        return None
+
+    rows = []
+
+    with zip_ref, io.TextIOWrapper(zip_ref.open(file), encoding="utf-8", newline='') as csvfile:
+        big_debug_text(f"{filenr}. {year}")
+        logging.info("==========> processing file %s: %s", filenr, file)
+
+        csvreader = csv.reader(csvfile, dialect='semikolon')
+        header = next(csvreader)
+        logging.debug("keys: %s", header)
+
+        # Resolve the columns and their converters once per file
+        schema = compile_schema(header, year)
+        missing_fields = [field for field, (index, converter) in zip(WANTED_FIELDS, schema) if index is None]
+        if missing_fields:
+            logging.debug("%s: fields not found: %s", filenr, missing_fields)
+        uland = header.index('ULAND')
+        uregbez = header.index('UREGBEZ')
+
+        rownr = 0
+        short_rows = 0
+        for row in csvreader:
+            rownr = rownr + 1
+            # blank lines (which DictReader skipped) and incomplete rows
+            if len(row) < len(header):
+                if row:
+                    short_rows = short_rows + 1
+                continue
+            if not (is_code(row[uland], WANTED_ULAND) and is_code(row[uregbez], WANTED_UREGBEZ)):
+                continue
+
+            rows.append([converter(row[index]) if index is not None else None for index, converter in schema])
+
+        logging.info("%s of %s rows wanted", len(rows), rownr)
+        if short_rows:
+            logging.warning("%s: skipped %s incomplete rows", year, short_rows)
+
+    if not rows:
+        return [[] for field in WANTED_FIELDS]
+    return [list(column) for column in zip(*rows)]
+
+
+def add_features(features_by_kreis, rows):
+    """ GeoJSON point features of the rows, grouped by Kreis """
+    kreis_index = WANTED_FIELDS.index('UKREIS')
+    lon_index = WANTED_FIELDS.index('XGCSWGS84')
+    lat_index = WANTED_FIELDS.index('YGCSWGS84')
+    property_fields = [(index, field) for index, field in enumerate(WANTED_FIELDS) if index not in (lon_index, lat_index)]
+
+    for row in rows:
+        try:
+            lon, lat = float(row[lon_index]), float(row[lat_index])
+        except (TypeError, ValueError):
+            continue
+        kreis = row[kreis_index].strip().zfill(2)[-2:]
+        features_by_kreis.setdefault(kreis, []).append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {field: row[index] for index, field in property_fields}
+        })
+
+
+def write_geojson_files(features_by_kreis):
+    """ Write one GeoJSON file per Kreis, and the index file with the name, count and bounding box of every file """
+    os.makedirs(GEOJSON_DIR, exist_ok=True)
+    index = {}
+    for kreis, features in sorted(features_by_kreis.items()):
+        filename = GEOJSON_FILE.format(kreis)
+        with open(GEOJSON_DIR + filename, 'w', encoding='utf-8') as outfile:
+            json.dump({"type": "FeatureCollection", "features": features}, outfile, ensure_ascii=False, separators=(',', ':'))
+
+        lons = [feature["geometry"]["coordinates"][0] for feature in features]
+        lats = [feature["geometry"]["coordinates"][1] for feature in features]
+        index[kreis] = {
+            "name": KREIS_NAMES.get(kreis, ''),
+            "file": filename,
+            "count": len(features),
+            "bbox": [min(lons), min(lats), max(lons), max(lats)],
+        }
+        logging.info("%s (%s): %s features", filename, index[kreis]["name"], len(features))
+
+    with open(GEOJSON_DIR + GEOJSON_INDEX_FILE, 'w', encoding='utf-8') as outfile:
+        json.dump(index, outfile, ensure_ascii=False, indent=2)
+
+
+def combine_csv_files(zipfiles):
+    """ Write the rows of Regierungsbezirk Münster of all years, from the cached partitions or the zip files,
+        to the csv file and to the GeoJSON files """
 
     csv.register_dialect('semikolon', delimiter=';')
     csv.register_dialect('komma', delimiter=',')
-    WANTED_FIELDS_STR = 'ULAND;UREGBEZ;UKREIS;UGEMEINDE;UJAHR;UMONAT;USTUNDE;UWOCHENTAG;UKATEGORIE;UART;UTYP1;ULICHTVERH;IstRad;IstPKW;IstFuss;IstKrad;IstGkfz;IstSonstige;LINREFX;LINREFY;XGCSWGS84;YGCSWGS84;STRZUSTAND;UIDENTSTLAE'
-    WANTED_FIELDS = WANTED_FIELDS_STR.split(";")
-
-    alle_unfaelle = []
 
-    geojson = {
-        "type": "FeatureCollection",
-        "features": []
-    }
+    features_by_kreis = {}
 
     outfile = OUTPUT_FILE
     with open(outfile, mode='w') as csv_file:
@@ -134,56 +338,26 @@ def combine_csv_files():
         writer = csv.writer(csv_file, dialect='excel')
         writer.writerow(WANTED_FIELDS)
 
-        for file in FILES:
-            filenr = 0
-            with open(CACHEDIR + 'csv/' + file, 'r', newline='', encoding="utf-8") as csvfile:
-                filenr = filenr + 1
-                big_debug_text(f"{filenr}. {file}")
-                logging.info("==========> processing file %s: %s", filenr, file)
-
-                csvreader = csv.DictReader(csvfile, dialect='semikolon')
-                rownr = 0
-                for row in csvreader:
-                    if rownr == 0:
-                        logging.debug("keys: %s", list(row.keys()))
-                        logging.debug("vals: %s", list(row.values()))
-                    rownr = rownr + 1
-                    if (int(row['ULAND']) == 5) and (int(row['UREGBEZ']) == 5):
-                        resultrow = {}
-                        for field in WANTED_FIELDS:
-                            if field in row:
-                                resultrow[field] = row[field]
-                            else:
-                                resultrow[field] = ''
-                                if rownr % 1000 == 0:
-                                    logging.debug("%s/%s '%s' not found", filenr, rownr, field)
-
-                        # Fix some field names that changed over time
-                        if "IstSonstig" in row:
-                            resultrow['IstSonstige'] = row['IstSonstig']
-                        if "IstStrassenzustand" in row:
-                            if rownr % 1000 == 0:
-                                logging.debug("%s/%s IstStrassenzustand found", filenr, rownr)
-                            resultrow['STRZUSTAND'] = row['IstStrassenzustand']
-                        if "USTRZUSTAND" in row:
-                            if rownr % 1000 == 0:
-                                logging.debug("%s/%s USTRZUSTAND found", filenr, rownr)
-                            resultrow['STRZUSTAND'] = row['USTRZUSTAND']
-
-                        # Convert german comma to decimal dot
-                        for field in ['LINREFX','LINREFY','XGCSWGS84','YGCSWGS84']:
-                            resultrow[field] = resultrow[field].replace(',','.')
-
-                        # Finally write row
-                        finalrow = []
-                        for field in WANTED_FIELDS:
-                            finalrow.append(resultrow[field])
-                        writer.writerow(finalrow)
-
-
-download_and_unzip_data()
-
-combine_csv_files()
+        for filenr, (year, zipfilename) in enumerate(sorted(zipfiles.items()), start=1):
+            source_hash = file_hash(zipfilename)
+            columns = load_partition(year, source_hash)
+            if columns is None:
+                columns = read_year(zipfilename, year, filenr)
+                if columns is None:
+                    continue
+                save_partition(year, source_hash, columns)
+            else:
+                logging.info("%s: %s rows from the cached partition", year, len(columns[0]))
+
+            # Finally write rows
+            rows = list(zip(*columns))
+            writer.writerows(rows)
+            add_features(features_by_kreis, rows)
+
+    write_geojson_files(features_by_kreis)
+
+
+combine_csv_files(download_data())
 
 
 
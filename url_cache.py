@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+File cache for downloads, shared by the converter scripts
+
+Cache files that are older than their max age are revalidated with ETag / Last-Modified,
+downloads are streamed to disk and replace the cache file atomically,
+and requests to the same host are spaced out so we don't kill a public server.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+import requests
+
+ONE_DAY = 60 * 60 * 24
+CHUNK_SIZE = 1024 * 64
+
+# Requests to the same host are started at least this many seconds apart
+DEFAULT_REQUEST_INTERVAL = 1
+
+HOST_LOCK = threading.Lock()
+NEXT_REQUEST_TIME = {}
+
+
+def wait_for_host(url, request_interval):
+    """ Block until the next request to the host of url is allowed """
+    host = urlparse(url).netloc
+    with HOST_LOCK:
+        now = time.monotonic()
+        next_time = NEXT_REQUEST_TIME.get(host, 0)
+        NEXT_REQUEST_TIME[host] = max(now, next_time) + request_interval
+    if next_time > now:
+        time.sleep(next_time - now)
+
+
+def is_fresh(filename, max_age):
+    """ Cache file exists and is not older than max_age seconds """
+    if not os.path.isfile(filename):
+        return False
+    file_age = time.time() - os.path.getmtime(filename)
+    if file_age > max_age:
+        logging.debug("# CACHE file age %s too old: %s", file_age, filename)
+        return False
+    return True
+
+
+def read_meta(filename):
+    """ ETag and Last-Modified of a cache file """
+    try:
+        with open(filename + '.meta', encoding='utf-8') as metafile:
+            return json.load(metafile)
+    except (OSError, ValueError):
+        return {}
+
+
+def download_with_cache(url, filename, max_age=30 * ONE_DAY, session=None, headers=None, timeout=120,
+                        request_interval=DEFAULT_REQUEST_INTERVAL, raise_on_error=False):
+    """
+    Download url to filename, unless the cache file is younger than max_age seconds.
+    Returns the HTTP status, or None if the cache file was used without a request.
+    """
+    if is_fresh(filename, max_age):
+        logging.debug("(using cached file instead of url get)")
+        return None
+
+    request_headers = dict(headers or {})
+    meta = read_meta(filename) if os.path.isfile(filename) else {}
+    if meta.get('etag'):
+        request_headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        request_headers['If-Modified-Since'] = meta['last_modified']
+
+    wait_for_host(url, request_interval)
+    logging.debug("# URL HTTP GET %s ", filename)
+    with (session or requests).get(url, headers=request_headers, timeout=timeout, stream=True) as response:
+
+        if response.status_code == 304:
+            logging.debug("(cache file is still up to date)")
+            os.utime(filename)
+            return 304
+
+        if response.status_code > 399:
+            logging.warning('  - Request result: HTTP %s - %s', response.status_code, url)
+            if raise_on_error:
+                raise FileNotFoundError(url)
+
+        # stream into a temporary file and replace the cache file when the download is complete
+        with open(filename + '.part', 'wb') as partfile:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                partfile.write(chunk)
+        os.replace(filename + '.part', filename)
+
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+        with open(filename + '.meta', 'w', encoding='utf-8') as metafile:
+            json.dump(meta, metafile)
+
+        return response.status_code
+
+
+def read_json_with_cache(url, filename, max_age=30 * ONE_DAY, **kwargs):
+    """ Download url with download_with_cache() and return its JSON, or {} for missing urls """
+    download_with_cache(url, filename, max_age, **kwargs)
+
+    with open(filename, 'rb') as cachefile:
+        jsn = json.load(cachefile)
+    if isinstance(jsn, dict) and jsn.get('status') == 404:
+        logging.warning('  - missing url: %s', url)
+        return {}
+    return jsn